@@ -1,11 +1,13 @@
-import arrow, fnmatch, re
-from main.functions import logger
+import arrow, fnmatch, re, os, json
+from atproto import models
+from main.functions import logger, atomic_write
 from settings.auth import BSKY_HANDLE
 from settings.paths import *
 from settings import settings
 from main.connections import bsky_connect
 from main.post import Post
 from main.db import database
+from main.feed_cursor import cursor
 # Getting posts from bluesky
 
 
@@ -16,161 +18,338 @@ def get_posts():
         logger.error("Could not connect to Bluesky.")
         return
     logger.info("Gathering posts from Bluesky")
-    posts = []
-    # Getting feed of user
-    profile_feed = bsky.app.bsky.feed.get_author_feed({'actor': BSKY_HANDLE})
-    for status in profile_feed.feed:
-        logger.trace(status)
-        post_id = status.post.cid
-        uri = status.post.uri
-        # If the post was not written by the account that posted it, it is a repost from another account and is skipped.
-        if status.post.author.handle != BSKY_HANDLE:
-            logger.info(f'Post {post_id} is a repost of another account: ({status.post.author.handle}).')
-            continue
-        # Checking if the post has "indexe_at" set, meaning it is a repost.
-        repost = False
-        created_at = get_date(status.post.record.created_at.split(".")[0])
-        logger.debug(f'Post created at: {created_at}')
-        if hasattr(status.reason, "indexed_at"):
-            repost = True
-            created_at = get_date(status.reason.indexed_at.split(".")[0])
-        # Checking if post is outside time limit
-        if not created_at > database.get_post_time_limit():
-            logger.info(f'Post {post_id} posted outside time limit.')
-            continue
-        # Checking if the status has already been posted to all required services (as well as adding it to the database)
-        if database.posted(post_id, uri = uri) and not repost:
-            logger.info(f'Post {post_id} already posted to all required services')
-            continue
-        # Checking if this is a repost of a post that can't be reposted because it has previously failed of been skipped
-        if repost and database.not_posted(post_id):
-            logger.info(f'Post {post_id} is a repost of a post that has previously failed or been skipped.')
-            continue
-        logger.debug(status)
-        # Facets contains things like urls and mentions, which need to be deal with.
-        # send_mention is used to keep track of if the mention-settings says for the post to be posted or not.
-        # Default is True, because if nobody is mentioned it should be posted.
-        text = status.post.record.text
-        mentioned_users = []
-        urls = []
-        tags = []
-        media = {}
-        if status.post.record.facets:
-            # Sometimes bluesky shortens URLs and in that case they need to be restored before crossposting
-            # (Also using this function to fetch hashtags)
-            text, urls, tags = restore_urls(status.post.record)
-            # Retrieving list of mentioned users
-            mentioned_users, text, urls = parse_facets(status.post.record, text, urls)
-        # Sometimes posts have included links that are not included in the actual text of the post. This adds adds that back.
-        if status.post.embed and hasattr(status.post.embed, "external") and hasattr(status.post.embed.external, "uri") and status.post.embed.external.uri not in text:
-            # Checking if the url is from media tenor, then it is to be treated as media instead of as a link.
-            if fnmatch.fnmatch(status.post.embed.external.uri, "*media.tenor.com*.gif*"): 
-                logger.info("Found media from Media Tenor, adding to media items.")
-                media = {
-                "type": "image",
-                "items": [{"url": status.post.embed.external.uri, "alt": re.sub("^Alt: ", "", status.post.embed.external.description, flags=re.I)}]
-                }
-            else:
-                logger.info(f"Restoring url {status.post.embed.external.uri} in post.")
-                text += '\n'+status.post.embed.external.uri
-                urls.append(status.post.embed.external.uri)
-        if mentioned_users and settings.mentions == "skip":
-            logger.info(f'post {post_id} mentions a user, crossposter has been set to skip posts including mentions.')
-            continue
-        # Setting reply_to_user to the same as user handle and only changing it if the post is an actual reply.
-        # Later a check is performed to if the variable is the same as the user handle, so only
-        # posts that are not replies, and posts that are part of a thread are posted.
-        reply_to_user = BSKY_HANDLE
-        reply_id = ""
-        # Checking if post is regular reply
-        if status.post.record.reply:
-            reply_id = status.post.record.reply.parent.cid
-            if getattr(status.reply.parent, 'not_found', False):
-                logger.info(f"Parent status {reply_id} seems to be deleted. Skipping post.")
-                continue
-            # Poster will try to fetch reply to-username the "ordinary" way, 
-            # and if it fails, it will try getting the entire thread and
-            # finding it that way
-            try:
-                reply_to_user = status.reply.parent.author.handle
-            except:
-                reply_to_user = bsky.get_reply_to_user(status.post.record.reply.parent)
-        # If post is a reply to another user, it is skipped
-        if reply_to_user != BSKY_HANDLE:
-            logger.info(f"Post {post_id} is a reply to another account ({reply_to_user}).")
-            continue
-        quoted_id = ""
-        quote_url = ""
-        # Checking if post is a quote post. Posts with references to feeds look like quote posts but aren't, and so will fail on missing attribute.
-        # Since quote posts can give values in two different ways it's a bit of a hassle to double check if it is an actual quote post,
-        # so instead I just try to run the function and if it fails I skip the post
-        # If there is some reason you would want to crosspost a post referencing a bluesky-feed that I'm not seeing, I might update this in the future.
-        if status.post.embed and hasattr(status.post.embed, "record"):
-            try:
-                quoted_user, quoted_id, quote_url, open = get_quote_post(status.post.embed.record)
-            except:
-                logger.debug(status)
-                logger.info(f"Could not get post quoted in {post_id}")
-                continue
-            # If post is a quote post of a post from another user, and quote-posting is disabled in settings
-            # or the post is not open to users not logged in, the post will be skipped
-            if quoted_user != BSKY_HANDLE and (not settings.quote_posts or not open):
-                continue
-            # If the post is a quote of user account, the url to the post is removed (if it was included).
-            # instead the version of the post from twitter or mastodon will be referenced.
-            elif quoted_user == BSKY_HANDLE:
-                text = text.replace(quote_url, "")
-        # Checking who is allowed to reply to the post
-        privacy_setting = get_privacy(status.post.threadgate)
-        # Checking if post has content warnings
-        sensitive = get_sensitive(status.post.record)
-        # Fetching images and video if there are any in the post
-        image_data = ""
-        video_data = {}
-        if status.post.embed and hasattr(status.post.embed, "images"):
-            image_data = status.post.embed.images
-        elif status.post.embed and hasattr(status.post.embed, "items"):
-            image_data = status.post.embed.items
-        elif status.post.embed and hasattr(status.post.embed, "media") and hasattr(status.post.embed.media, "images"):
-            image_data = status.post.embed.media.images
-        elif  status.post.record.embed and (hasattr(status.post.record.embed, "video") \
-            or (hasattr(status.post.record.embed, "media") and hasattr(status.post.record.embed.media, "video"))):
-            video_data = get_video_data(status)
-            media = {
-                "type": "video",
-                "items": [video_data]
-            }
-            logger.debug(f"Found video: {video_data}")
-        if image_data:
-            images = []
-            for image in image_data:
-                images.append({"url": image.fullsize, "alt": image.alt})
+    feed = get_feed(bsky)
+    resolve_reply_authors(bsky, [status for position, status in feed if status])
+    # Posts are parsed and handed on one at a time, oldest first, so that the first post can be sent
+    # before the rest have been parsed.
+    for position, status in reversed(feed):
+        # Posts read as plain json have already been checked while the feed was read
+        post_info = parse_status(bsky, status, checked = settings.raw_feed) if status else None
+        cursor.seen(position["cid"], position)
+        if post_info:
+            yield Post(post_info)
+
+
+# Parsing a post from the feed. Returns None if the post is not to be crossposted. If checked is set, the post
+# has already been through wanted().
+def parse_status(bsky, status, checked = False):
+    logger.trace(status)
+    post_id = status.post.cid
+    # Checking if the post has "indexe_at" set, meaning it is a repost.
+    repost = hasattr(status.reason, "indexed_at")
+    created_at = get_date((status.reason.indexed_at if repost else status.post.record.created_at).split(".")[0])
+    if not checked and not wanted(post_id, status.post.uri, status.post.author.handle, created_at, repost):
+        return None
+    # Checking if this is a repost of a post that can't be reposted because it has previously failed of been skipped
+    if repost and database.not_posted(post_id):
+        logger.info(f'Post {post_id} is a repost of a post that has previously failed or been skipped.')
+        return None
+    logger.debug(status)
+    # Facets contains things like urls and mentions, which need to be deal with.
+    # send_mention is used to keep track of if the mention-settings says for the post to be posted or not.
+    # Default is True, because if nobody is mentioned it should be posted.
+    text = status.post.record.text
+    mentioned_users = []
+    urls = []
+    tags = []
+    media = {}
+    if status.post.record.facets:
+        # Sometimes bluesky shortens URLs and in that case they need to be restored before crossposting.
+        # Hashtags and mentioned users are retrieved at the same time.
+        text, urls, tags, mentioned_users = parse_facets(status.post.record)
+    # Sometimes posts have included links that are not included in the actual text of the post. This adds adds that back.
+    if status.post.embed and hasattr(status.post.embed, "external") and hasattr(status.post.embed.external, "uri") and status.post.embed.external.uri not in text:
+        # Checking if the url is from media tenor, then it is to be treated as media instead of as a link.
+        if fnmatch.fnmatch(status.post.embed.external.uri, "*media.tenor.com*.gif*"): 
+            logger.info("Found media from Media Tenor, adding to media items.")
             media = {
-                "type": "image",
-                "items": images
+            "type": "image",
+            "items": [{"url": status.post.embed.external.uri, "alt": re.sub("^Alt: ", "", status.post.embed.external.description, flags=re.I)}]
             }
-        post_info = {
-            "post_id": post_id,
-            "text": text,
-            "urls": urls,
-            "tags": tags,
-            "reply_id": reply_id,
-            "quote_id": quoted_id,
-            "quote_url": quote_url,
-            "media": media,
-            "sensitive": sensitive,
-            "language": status.post.record.langs,
-            "privacy": privacy_setting,
-            "repost": repost,
-            "created_at": created_at
+        else:
+            logger.info(f"Restoring url {status.post.embed.external.uri} in post.")
+            text += '\n'+status.post.embed.external.uri
+            urls.append(status.post.embed.external.uri)
+    if mentioned_users and settings.mentions == "skip":
+        logger.info(f'post {post_id} mentions a user, crossposter has been set to skip posts including mentions.')
+        return None
+    # Setting reply_to_user to the same as user handle and only changing it if the post is an actual reply.
+    # Later a check is performed to if the variable is the same as the user handle, so only
+    # posts that are not replies, and posts that are part of a thread are posted.
+    reply_to_user = BSKY_HANDLE
+    reply_id = ""
+    # Checking if post is regular reply
+    if status.post.record.reply:
+        reply_id = status.post.record.reply.parent.cid
+        if getattr(status.reply.parent, 'not_found', False):
+            logger.info(f"Parent status {reply_id} seems to be deleted. Skipping post.")
+            return None
+        # Poster will try to fetch reply to-username the "ordinary" way, 
+        # and if it fails, it will look up the post replied to
+        try:
+            reply_to_user = status.reply.parent.author.handle
+        except:
+            reply_to_user = get_reply_author(bsky, status.post.record.reply.parent.uri)
+    # If post is a reply to another user, it is skipped
+    if reply_to_user != BSKY_HANDLE:
+        logger.info(f"Post {post_id} is a reply to another account ({reply_to_user}).")
+        return None
+    quoted_id = ""
+    quote_url = ""
+    # Checking if post is a quote post. Posts with references to feeds look like quote posts but aren't, and so will fail on missing attribute.
+    # Since quote posts can give values in two different ways it's a bit of a hassle to double check if it is an actual quote post,
+    # so instead I just try to run the function and if it fails I skip the post
+    # If there is some reason you would want to crosspost a post referencing a bluesky-feed that I'm not seeing, I might update this in the future.
+    if status.post.embed and hasattr(status.post.embed, "record"):
+        try:
+            quoted_user, quoted_id, quote_url, open = get_quote_post(status.post.embed.record)
+        except:
+            logger.debug(status)
+            logger.info(f"Could not get post quoted in {post_id}")
+            return None
+        # If post is a quote post of a post from another user, and quote-posting is disabled in settings
+        # or the post is not open to users not logged in, the post will be skipped
+        if quoted_user != BSKY_HANDLE and (not settings.quote_posts or not open):
+            return None
+        # If the post is a quote of user account, the url to the post is removed (if it was included).
+        # instead the version of the post from twitter or mastodon will be referenced.
+        elif quoted_user == BSKY_HANDLE:
+            text = text.replace(quote_url, "")
+    # Checking who is allowed to reply to the post
+    privacy_setting = get_privacy(status.post.threadgate)
+    # Checking if post has content warnings
+    sensitive = get_sensitive(status.post.record)
+    # Fetching images and video if there are any in the post
+    image_data = ""
+    video_data = {}
+    if status.post.embed and hasattr(status.post.embed, "images"):
+        image_data = status.post.embed.images
+    elif status.post.embed and hasattr(status.post.embed, "items"):
+        image_data = status.post.embed.items
+    elif status.post.embed and hasattr(status.post.embed, "media") and hasattr(status.post.embed.media, "images"):
+        image_data = status.post.embed.media.images
+    elif  status.post.record.embed and (hasattr(status.post.record.embed, "video") \
+        or (hasattr(status.post.record.embed, "media") and hasattr(status.post.record.embed.media, "video"))):
+        video_data = get_video_data(status)
+        media = {
+            "type": "video",
+            "items": [video_data]
         }
-        logger.debug(post_info)
-        posts.append(post_info)
-    posts = sorted(posts, key=lambda d: d['created_at'])
-    post_dict = {}
-    for post in posts:
-        post_dict[post["post_id"]] = Post(post)
-    return post_dict
+        logger.debug(f"Found video: {video_data}")
+    if image_data:
+        images = []
+        for image in image_data:
+            images.append({"url": image.fullsize, "alt": image.alt})
+        media = {
+            "type": "image",
+            "items": images
+        }
+    post_info = {
+        "post_id": post_id,
+        "text": text,
+        "urls": urls,
+        "tags": tags,
+        "reply_id": reply_id,
+        "quote_id": quoted_id,
+        "quote_url": quote_url,
+        "media": media,
+        "sensitive": sensitive,
+        "language": status.post.record.langs,
+        "privacy": privacy_setting,
+        "repost": repost,
+        "created_at": created_at
+    }
+    logger.debug(post_info)
+    return post_info
+
+
+# The checks that decide if a post is to be crossposted at all, which only need the ID, author and time of the post.
+# Returns False if the post is to be skipped.
+def wanted(post_id, uri, author, created_at, repost):
+    # If the post was not written by the account that posted it, it is a repost from another account and is skipped.
+    if author != BSKY_HANDLE:
+        logger.info(f'Post {post_id} is a repost of another account: ({author}).')
+        return False
+    logger.debug(f'Post created at: {created_at}')
+    # Checking if post is outside time limit
+    if not created_at > database.get_post_time_limit():
+        logger.info(f'Post {post_id} posted outside time limit.')
+        return False
+    # Checking if the status has already been posted to all required services (as well as adding it to the database)
+    if database.posted(post_id, uri = uri, archived = repost) and not repost:
+        logger.info(f'Post {post_id} already posted to all required services')
+        return False
+    return True
+
+
+# The feed usually includes who the posts replied to were written by, but not always. Those authors are looked up
+# before the posts are parsed, all at once, and stored so that the same post never has to be looked up twice.
+def resolve_reply_authors(bsky, feed):
+    uris = []
+    for status in feed:
+        parent = status.reply.parent if status.reply else None
+        if not status.post.record.reply or getattr(parent, "author", None) or getattr(parent, "not_found", False):
+            continue
+        uri = status.post.record.reply.parent.uri
+        if uri not in reply_authors and uri not in uris:
+            uris.append(uri)
+    if not uris:
+        return
+    logger.info(f"Looking up authors of {len(uris)} posts replied to")
+    try:
+        reply_authors.update(bsky.get_post_authors(uris))
+    except Exception as e:
+        logger.error(f"Could not look up authors of posts replied to: {e}")
+        return
+    save_reply_authors()
+
+
+# Getting the author of a post replied to, looking it up if it is not already known. Returns an empty
+# string if the post can't be found, which is most likely because it has been deleted.
+def get_reply_author(bsky, uri):
+    if uri not in reply_authors:
+        try:
+            reply_authors.update(bsky.get_post_authors([uri]))
+            save_reply_authors()
+        except Exception as e:
+            logger.info("Unable to retrieve reply_to-user of post. Probably a reply to a deleted post.")
+            logger.debug(e)
+    return reply_authors.get(uri, "")
+
+
+def read_reply_authors():
+    if not os.path.exists(reply_author_cache_path):
+        return {}
+    try:
+        with open(reply_author_cache_path, 'r') as file:
+            return json.load(file)
+    except Exception as e:
+        logger.error(f"Could not read reply author cache: {e}")
+        return {}
+
+
+# Saving the cache of authors, keeping only the most recently added ones so that it doesn't grow forever
+def save_reply_authors():
+    for uri in list(reply_authors)[:-1000]:
+        del reply_authors[uri]
+    atomic_write(reply_author_cache_path, [json.dumps(reply_authors)])
+
+
+# Getting feed of user, page by page, until the high-water mark or the post time limit is reached.
+# If nothing has been posted since the last run, this only takes a single small request.
+# Returns the position of every post in the feed along with the post, or None in place of posts already skipped.
+def get_feed(bsky):
+    high_water_mark = cursor.position
+    # When streaming, the high-water mark may only contain the position in the stream
+    if high_water_mark and "indexed_at" not in high_water_mark:
+        high_water_mark = None
+    time_limit = database.get_post_time_limit()
+    params = {'actor': BSKY_HANDLE, 'limit': 10 if high_water_mark else 50}
+    feed = []
+    while True:
+        if settings.raw_feed:
+            page, page_cursor = get_raw_page(bsky, params, high_water_mark)
+        else:
+            profile_feed = bsky.app.bsky.feed.get_author_feed(params)
+            page = [(get_position(status), status) for status in profile_feed.feed]
+            page_cursor = profile_feed.cursor
+        for position, status in page:
+            if high_water_mark and reached(position, high_water_mark):
+                return feed
+            feed.append((position, status))
+        if not page_cursor or not page:
+            return feed
+        if get_date(page[-1][0]["indexed_at"].split(".")[0]) < time_limit:
+            return feed
+        logger.info("Reading next page of feed")
+        params["cursor"] = page_cursor
+        params["limit"] = 50
+
+
+# Reading a page of the feed as plain json instead of as models. Most posts in the feed are skipped, and that
+# can be decided from the ID, author and time of the post alone, so only the posts that are not skipped
+# are turned into models. Nothing past the high-water mark is checked, since the feed is not read past it.
+def get_raw_page(bsky, params, high_water_mark):
+    profile_feed = bsky.get_author_feed_raw(params)
+    page = []
+    for item in profile_feed["feed"]:
+        post = item["post"]
+        reason = item.get("reason") or {}
+        repost = "indexedAt" in reason
+        position = {"indexed_at": reason["indexedAt"] if repost else post["indexedAt"], "cid": post["cid"]}
+        if high_water_mark and reached(position, high_water_mark):
+            page.append((position, None))
+            break
+        created_at = get_date((reason["indexedAt"] if repost else post["record"]["createdAt"]).split(".")[0])
+        status = None
+        if wanted(post["cid"], post["uri"], post["author"]["handle"], created_at, repost):
+            status = models.get_or_create(item, models.AppBskyFeedDefs.FeedViewPost, strict = False)
+        page.append((position, status))
+    return page, profile_feed.get("cursor")
+
+
+# The position of a post in the feed is the time it was added to the feed, which for reposts is the time
+# of the repost, along with the CID to tell posts added at the same time apart.
+def get_position(status):
+    indexed_at = status.reason.indexed_at if hasattr(status.reason, "indexed_at") else status.post.indexed_at
+    return {"indexed_at": indexed_at, "cid": status.post.cid}
+
+
+# Checking if a position in the feed is at or before the high-water mark
+def reached(position, high_water_mark):
+    indexed_at = arrow.get(position["indexed_at"])
+    mark = arrow.get(high_water_mark["indexed_at"])
+    return indexed_at < mark or (indexed_at == mark and position["cid"] == high_water_mark["cid"])
+
+
+# The stream only contains the record of a post, so the post is looked up to get it in the same form as it has
+# in the feed. If the post is a reply, the posts replied to are looked up along with it, since the feed includes them.
+# If the post is being reposted, reposted_at is the time of the repost. Returns None if the post can't be found.
+def get_stream_status(bsky, uri, reposted_at = None):
+    posts = bsky.app.bsky.feed.get_posts({"uris": [uri]}).posts
+    if not posts:
+        logger.info(f"Could not find post {uri}")
+        return None
+    post = posts[0]
+    reply = None
+    if post.record.reply:
+        parent_uri = post.record.reply.parent.uri
+        root_uri = post.record.reply.root.uri
+        found = {found.uri: found for found in bsky.app.bsky.feed.get_posts({"uris": list({parent_uri, root_uri})}).posts}
+        reply = models.AppBskyFeedDefs.ReplyRef(
+            parent = found.get(parent_uri) or models.AppBskyFeedDefs.NotFoundPost(uri = parent_uri, not_found = True),
+            root = found.get(root_uri) or models.AppBskyFeedDefs.NotFoundPost(uri = root_uri, not_found = True)
+        )
+    reason = None
+    if reposted_at:
+        reason = models.AppBskyFeedDefs.ReasonRepost(by = post.author, indexed_at = reposted_at)
+    return models.AppBskyFeedDefs.FeedViewPost(post = post, reply = reply, reason = reason)
+
+
+# Looking up potentially deleted posts by URI. Posts that can't be found have been deleted. get_posts accepts
+# up to 25 URIs at a time, so this is done in batches. If a lookup fails, the posts in it are treated as not deleted.
+def get_deleted(candidates):
+    bsky = bsky_connect()
+    if not bsky:
+        logger.error("Could not connect to Bluesky.")
+        return set()
+    uris = {}
+    for post_id in candidates:
+        cid, uri = database.get_id(post_id, "bluesky")
+        if uri:
+            uris[uri] = post_id
+    deleted = set()
+    uri_list = list(uris)
+    for i in range(0, len(uri_list), 25):
+        batch = uri_list[i:i + 25]
+        try:
+            response = bsky.app.bsky.feed.get_posts({"uris": batch})
+        except Exception as e:
+            logger.error(f"Could not check if posts have been deleted: {e}")
+            continue
+        found = {post.uri for post in response.posts}
+        deleted.update(uris[uri] for uri in batch if uri not in found)
+    return deleted
 
 
 # Sometimes the date string is given in a different format, this is dealt with here.
@@ -213,54 +392,53 @@ def get_sensitive(record):
             return True
     return False
 
-# Function for restoring shortened URLS
-def restore_urls(record):
+# Going through the facets of a post, which contain things like urls, mentions and hashtags. Each facet designates
+# the bytes of the text it applies to, so the text is rebuilt in one pass over the UTF-8 encoded text, in the order
+# the facets appear. Shortened URLs are restored to the actual URL, and mentions are converted to whatever format
+# is selected in settings. Returns the new text along with the urls, hashtags and mentioned users found.
+def parse_facets(record):
     urls = []
     tags = []
-    text = record.text
-    encoded_text = text.encode("UTF-8")
-    for facet in record.facets:
-        if facet.features[0].py_type == "app.bsky.richtext.facet#tag":
-            tags.append(facet.features[0].tag)
-        if facet.features[0].py_type != "app.bsky.richtext.facet#link":
-            continue
-        url = facet.features[0].uri
-        urls.append(url)
-        # The index section designates where a URL starts end ends. Using this the exact
-        # string representing the URL in the post can be identified, and replace it with the actual URL.
-        start = facet.index.byte_start
-        end = facet.index.byte_end
-        section = encoded_text[start:end]
-        shortened = section.decode("UTF-8")
-        text = text.replace(shortened, url)
-    return text, urls, tags
-
-# Function for retrieving users and urls from facets, and converting the user to whatever format is selected in settings
-def parse_facets(record, text, urls):
     users = []
-    encoded_text = text.encode("UTF-8")
-    for facet in record.facets:
-        if facet.features[0].py_type != "app.bsky.richtext.facet#mention":
-            continue
-        # The index section designates where a username starts end ends. Using this the exact
-        # string representing the user in the post can be identified, and replace it with the corrected value
+    encoded_text = record.text.encode("UTF-8")
+    parts = []
+    position = 0
+    for facet in sorted(record.facets, key=lambda facet: facet.index.byte_start):
         start = facet.index.byte_start
         end = facet.index.byte_end
-        username = encoded_text[start:end]
-        username = username.decode("UTF-8")
-        # Removing @ in the beginning of username if mentions are set to "strip"
-        if settings.mentions == "strip":
-            text = text.replace(username, username.replace("@", ""))
-        # Switching out username for url to user if mentions are set to "url"
-        if settings.mentions == "url":
-            base_url = "https://bsky.app/profile/"
-            did = facet.features[0].did
-            url = base_url + did
-            urls.append(url)
-            text = text.replace(username, url)
-            username = url
-        users.append(username)
-    return users, text, urls
+        # Facets overlapping a previous one or pointing outside the text are ignored
+        if start < position or end > len(encoded_text) or start > end:
+            continue
+        feature = facet.features[0]
+        if feature.py_type == "app.bsky.richtext.facet#link":
+            urls.append(feature.uri)
+            replacement = feature.uri
+        elif feature.py_type == "app.bsky.richtext.facet#tag":
+            tags.append(feature.tag)
+            continue
+        elif feature.py_type == "app.bsky.richtext.facet#mention":
+            username = encoded_text[start:end].decode("UTF-8", errors="replace")
+            users.append(username)
+            # Removing @ in the beginning of username if mentions are set to "strip"
+            if settings.mentions == "strip":
+                replacement = username.replace("@", "")
+            # Switching out username for url to user if mentions are set to "url"
+            elif settings.mentions == "url":
+                replacement = "https://bsky.app/profile/" + feature.did
+                urls.append(replacement)
+                users[-1] = replacement
+            else:
+                continue
+        else:
+            continue
+        parts.append(encoded_text[position:start])
+        parts.append(replacement.encode("UTF-8"))
+        position = end
+    # If nothing in the text was replaced, the original text can be used as it is
+    if not parts:
+        return record.text, urls, tags, users
+    parts.append(encoded_text[position:])
+    return b"".join(parts).decode("UTF-8", errors="replace"), urls, tags, users
 
 
 # Quoted posts can be stored in several different ways for some reason. 
@@ -302,4 +480,8 @@ def get_video_data(post_data):
     # Setting alt to empty string if it is noneType
     if not alt:
         alt = ""
-    return {"url": url, "alt": alt}
\ No newline at end of file
+    return {"url": url, "alt": alt}
+
+
+# Authors of posts replied to, by URI
+reply_authors = read_reply_authors()
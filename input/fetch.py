@@ -1,9 +1,13 @@
 import arrow
-from copy import deepcopy
+from collections import deque
+from itertools import chain
 from settings import settings
 from main.functions import logger, get_outputs
+from main.post import PostView
 from input import bluesky, mastodon
 from main.db import database
+from main.feed_cursor import cursor
+from main.outbox import outbox
 
 
 def get_posts():
@@ -14,20 +18,39 @@ def get_posts():
         posts = mastodon.get_posts()
     else:
         logger.error(f"Unknown input source: {settings.input_source}")
-    if not posts:
-        logger.warning("No posts found from input.")
-        exit()
-    # Getting queues for all active outputs
-    queues = {}
-    for output in get_outputs():
-        queues[output] = []
-    # Further parsing the posts to get an actual list of posts to send.
-    for post_id in posts:
+        posts = []
+    # Posts left in the outbox are delivered first. The input is only read once they are done.
+    return chain(outbox.resume(), get_queues(prefetch(posts)))
+
+
+# Reading a few posts ahead of the one being sent, so that their media can start downloading in the background
+# while the posts before them are being sent. Only posts that look like they will be sent somewhere for the first
+# time have their media downloaded, the actual decision is still made in get_queues.
+def prefetch(posts):
+    ahead = deque()
+    for source_post in posts:
+        if source_post.info["media"]:
+            entry = database.get_entry(source_post.info["post_id"])
+            if any(source_post.post_toggle(service) and not (entry and entry.get_id(service)) for service in get_outputs()):
+                source_post.get_media()
+        ahead.append(source_post)
+        if len(ahead) > settings.media_workers:
+            yield ahead.popleft()
+    while ahead:
+        yield ahead.popleft()
+
+
+# Further parsing the posts to get what to send to each output. The posts are handled one at a time as they are
+# read, and for every post that is to be sent anywhere, the post data for each output is handed on.
+def get_queues(posts):
+    for source_post in posts:
+        post_id = source_post.info["post_id"]
         # Checking if a maximum amount of posts per hour is set, and if so if it has been reached.
-        if settings.max_per_hour != 0 and len(database.cache) >= settings.max_per_hour:
+        # The posts after this one are never read from the feed, so the mark stops here and they are read again next run.
+        if settings.max_per_hour != 0 and database.sent_last_hour() >= settings.max_per_hour:
             logger.info("Max posts per hour reached.")
+            cursor.hold(post_id)
             break
-        source_post = posts[post_id]
         # Checking what services this specific post should be sent to
         outputs = []
         for service in get_outputs():
@@ -36,6 +59,10 @@ def get_posts():
             if not source_post.post_toggle(service):
                 database.skip(post_id, service)
                 continue
+            # Posts already in the outbox have been tried this run, and are left to be retried from there
+            elif outbox.has(post_id, service):
+                logger.info(f"{post_id} is waiting in the outbox for {service}")
+                continue
             elif not database.posted(post_id, [service]):
                 logger.info(f"{post_id} has not been posted to {service}")
                 # Adding service either as post or repost, depending on if it has been posted before or not. 
@@ -48,43 +75,57 @@ def get_posts():
         if not outputs:
             logger.info(f"Post {post_id} is not set to be posted to any service. Skipping to next post.")
             continue
-        post_data = {
-            "id": post_id,
-            "type": "post", #post, reply, repost, quote
-            "post": posts[post_id]
-        }
+        post_type = "post" #post, reply, repost, quote
         # If it is a reply, getting the IDs of the posts to reply to from the database.
         # If post is not found in database, the thread can't continue on mastodon and twitter,
         # and so is skipped.
-        if source_post.info["reply_id"] and source_post.info["reply_id"] in database.post_list:
-            post_data["type"] = "reply"
-        elif source_post.info["reply_id"] and source_post.info["reply_id"] not in database.post_list:
+        if source_post.info["reply_id"] and database.exists(source_post.info["reply_id"]):
+            post_type = "reply"
+        elif source_post.info["reply_id"] and not database.exists(source_post.info["reply_id"]):
             logger.info(f"Post {post_id} was a reply to a post that is not in the database.")
             continue
         # If post is a quote post, getting the IDs of the posts to quote from the database.
         # If the posts are not found in the database, checking if the quote_post setting is true or false in settings.
         # If true, adding the URL of the bluesky post to the text of the post, if false, skipping the post.
-        if source_post.info["quote_id"] and source_post.info["quote_id"] in database.post_list:
-            post_data["type"] = "quote"
-        elif source_post.info["quote_id"] and source_post.info["quote_id"]  not in database.post_list:
+        if source_post.info["quote_id"] and database.exists(source_post.info["quote_id"]):
+            post_type = "quote"
+        elif source_post.info["quote_id"] and not database.exists(source_post.info["quote_id"]):
             # Adding url to quoted post to text of post if quote post is set to true in the settings
-            if not source_post.quote_link():
+            source_post = source_post.quote_link()
+            if not source_post:
                 logger.info(f"Post {post_id} was a quote of a post that is not in the database.")
                 continue
         # Checking if the post has media and if it should be sent anywhere for the first time, in which case media is downloaded
         if source_post.info["media"] and next((item for item in outputs if item["type"] == "post"), False):
             source_post.get_media()
         # If a repost is found within the last hour, checking the cache to see if it has already been reposted
-        repost_timelimit = arrow.utcnow().shift(hours = -1)
-        if post_id in database.cache:
-            repost_timelimit = database.cache[post_id]
+        repost_timelimit = database.last_sent(post_id) or arrow.utcnow().shift(hours = -1)
+        queues = {}
         for output in outputs:
-            # Making separate copies of the post-data for the different services
-            post = deepcopy(post_data)
+            # Every service gets its own view of the post, while the post itself is shared
+            post = PostView(source_post, output["name"], post_type)
             # Adding repost if post is before the repost time limit, otherwise skipping
             if output["type"] == "repost" and source_post.info["created_at"] > repost_timelimit:
-                post["type"] = "repost"
+                post.type = "repost"
             elif output["type"] == "repost" and source_post.info["created_at"] < repost_timelimit:
                 continue
-            queues[output["name"]].append(post)
-    return queues
\ No newline at end of file
+            queues[output["name"]] = post
+            cursor.hold(post_id)
+        if queues:
+            yield queues
+
+
+# Checking which of the potentially deleted posts have actually been deleted from the input source. Posts found
+# in the feed have already been removed from the set, so only the rest need to be looked up.
+def get_deleted():
+    if not database.deleted:
+        return
+    logger.info(f"Checking if {len(database.deleted)} posts have been deleted.")
+    if settings.input_source == "bluesky":
+        deleted = bluesky.get_deleted(database.deleted)
+    elif settings.input_source == "mastodon":
+        deleted = mastodon.get_deleted(database.deleted)
+    else:
+        deleted = set()
+    logger.info(f"Found {len(deleted)} deleted posts.")
+    database.deleted = deleted
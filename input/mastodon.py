@@ -1,9 +1,11 @@
 import arrow, html, re
+from mastodon import MastodonError, MastodonNotFoundError
 import settings.settings as settings
 from main.functions import logger, extract_urls, clean_html
 from main.connections import mastodon_connect
 from main.post import Post
 from main.db import database
+from main.feed_cursor import cursor
 
 
 def get_posts():
@@ -13,82 +15,133 @@ def get_posts():
         return
     logger.info("Gathering posts from Mastodon")
     user_id = mastodon.me()["id"]
-    statuses = mastodon.account_statuses(user_id)
-    posts = []
-    for status in statuses:
-        logger.trace(status)
-        post_id = str(status.id)
-        # If post is a reply and the reply is to another account, it will not be crossposted. Same if it is a repost of a post from another account.
-        if (status.in_reply_to_account_id and status.in_reply_to_account_id != user_id) or (status.reblog and status.reblog.account.id != user_id):
-            logger.info(f'Post {post_id} is a reply to or reblog of another account.')
-            continue
-        created_at = arrow.get(status.created_at)
-        # Checking if post is outside time limit
-        if not created_at > database.get_post_time_limit():
-            logger.info(f'Post {post_id} posted outside time limit.')
-            continue
-        # Checking if the status has already been posted to all required services (as well as adding it to the database)
-        if database.posted(post_id) and not status.reblog:
-            logger.info(f'Post {post_id} already posted to all required services')
-            continue
-        # Checking if this is a repost of a post that can't be reposted because it has previously failed of been skipped
-        if status.reblog and database.not_posted(post_id):
-            logger.info(f'Post {post_id} is a repost of a post that has previously failed or been skipped.')
-            continue
-        if status.mentions and settings.mentions == "skip":
-            logger.info(f'post {post_id} mentions a user, crossposter has been set to skip posts including mentions.')
+    statuses = get_statuses(mastodon, user_id)
+    # Statuses are parsed and handed on one at a time, oldest first, so that the first status can be sent
+    # before the rest have been parsed.
+    for status in reversed(statuses):
+        post_info = parse_status(status, user_id)
+        cursor.seen(str(status.id), {"id": str(status.id)})
+        if post_info:
+            yield Post(post_info)
+
+
+# Parsing a status from the timeline of the account. Returns None if the status is not to be crossposted.
+def parse_status(status, user_id):
+    logger.trace(status)
+    post_id = str(status.id)
+    # If post is a reply and the reply is to another account, it will not be crossposted. Same if it is a repost of a post from another account.
+    if (status.in_reply_to_account_id and status.in_reply_to_account_id != user_id) or (status.reblog and status.reblog.account.id != user_id):
+        logger.info(f'Post {post_id} is a reply to or reblog of another account.')
+        return None
+    created_at = arrow.get(status.created_at)
+    # Checking if post is outside time limit
+    if not created_at > database.get_post_time_limit():
+        logger.info(f'Post {post_id} posted outside time limit.')
+        return None
+    # Checking if the status has already been posted to all required services (as well as adding it to the database)
+    if database.posted(post_id, archived = bool(status.reblog)) and not status.reblog:
+        logger.info(f'Post {post_id} already posted to all required services')
+        return None
+    # Checking if this is a repost of a post that can't be reposted because it has previously failed of been skipped
+    if status.reblog and database.not_posted(post_id):
+        logger.info(f'Post {post_id} is a repost of a post that has previously failed or been skipped.')
+        return None
+    if status.mentions and settings.mentions == "skip":
+        logger.info(f'post {post_id} mentions a user, crossposter has been set to skip posts including mentions.')
+        return None
+    elif status.mentions:
+        text, urls = parse_mentioned_users(status.mentions, text, urls)
+    logger.debug(status)
+    # Getting text content and converting it from html to a regular string
+    text = ""
+    urls = []
+    if status.content:
+        # Removing paragraph end tag from post to avoid trailing newlines
+        text = re.sub('</p>$', "", status.content)
+        # Using replace to retain newlines before removing all other html
+        text = text.replace("<p>", "").replace("</p>", "\n\n").replace("<br />", "\n")
+        text = clean_html(text)
+        text = html.unescape(text)
+        # Extracting URLs from status
+        urls = extract_urls(text)
+    # Getting media items and tags from post
+    media = {}
+    tags = []
+    if status.tags:
+        for tag in status.tags:
+            tags.append(tag.name)
+    if status.media_attachments:
+        items = []
+        for item in status.media_attachments:
+            media["type"] = item.type
+            items.append({"url": item.url, "alt": item.description})
+        media["items"] = items
+    post_info = {
+        "post_id": post_id,
+        "text": text,
+        "urls": urls,
+        "tags": tags,
+        "reply_id": status.in_reply_to_id,
+        # Quote posts are not applicable for mastodon
+        "quote_id": None,
+        "quote_url": None,
+        "media": media,
+        "sensitive": status.sensitive,
+        "privacy": get_privacy(status.visibility),
+        "language": [status.language],
+        "repost": (status.reblog),
+        "created_at": created_at
+    }
+    return post_info
+
+
+# Getting the statuses posted since the high-water mark. Mastodon returns the statuses closest to min_id, so
+# the statuses are read page by page going forward until there are no more. If nothing has been posted since
+# the last run, this only takes a single request. Statuses are returned newest first, just like the timeline.
+def get_statuses(mastodon, user_id):
+    if not cursor.position:
+        return mastodon.account_statuses(user_id)
+    statuses = []
+    min_id = cursor.position["id"]
+    while True:
+        page = mastodon.account_statuses(user_id, min_id = min_id, limit = 40)
+        if not page:
+            break
+        page = sorted(page, key = lambda status: int(status.id))
+        statuses += page
+        min_id = page[-1].id
+        if len(page) < 40:
+            break
+        logger.info("Reading next page of statuses")
+    return list(reversed(statuses))
+
+
+# Looking up potentially deleted posts. Posts that can't be found have been deleted. Newer Mastodon servers can
+# look up 20 posts at a time, older ones have to be asked about each post separately. If a lookup fails
+# for any other reason, the post is treated as not deleted.
+def get_deleted(candidates):
+    mastodon = mastodon_connect()
+    if not mastodon:
+        logger.error("Could not connect to Mastodon.")
+        return set()
+    ids = list(candidates)
+    deleted = set()
+    for i in range(0, len(ids), 20):
+        batch = ids[i:i + 20]
+        try:
+            found = {str(status.id) for status in mastodon.statuses(batch)}
+            deleted.update(post_id for post_id in batch if post_id not in found)
             continue
-        elif status.mentions:
-            text, urls = parse_mentioned_users(status.mentions, text, urls)
-        logger.debug(status)
-        # Getting text content and converting it from html to a regular string
-        text = ""
-        urls = []
-        if status.content:
-            # Removing paragraph end tag from post to avoid trailing newlines
-            text = re.sub('</p>$', "", status.content)
-            # Using replace to retain newlines before removing all other html
-            text = text.replace("<p>", "").replace("</p>", "\n\n").replace("<br />", "\n")
-            text = clean_html(text)
-            text = html.unescape(text)
-            # Extracting URLs from status
-            urls = extract_urls(text)
-        # Getting media items and tags from post
-        media = {}
-        tags = []
-        if status.tags:
-            for tag in status.tags:
-                tags.append(tag.name)
-        if status.media_attachments:
-            items = []
-            for item in status.media_attachments:
-                media["type"] = item.type
-                items.append({"url": item.url, "alt": item.description})
-            media["items"] = items
-        post_info = {
-            "post_id": post_id,
-            "text": text,
-            "urls": urls,
-            "tags": tags,
-            "reply_id": status.in_reply_to_id,
-            # Quote posts are not applicable for mastodon
-            "quote_id": None,
-            "quote_url": None,
-            "media": media,
-            "sensitive": status.sensitive,
-            "privacy": get_privacy(status.visibility),
-            "language": [status.language],
-            "repost": (status.reblog),
-            "created_at": created_at
-        }
-        posts.append(post_info)
-    # Sorting posts by creation date
-    posts = sorted(posts, key=lambda d: d['created_at'])
-    post_dict = {}
-    # Creating post objects and placing in a dict
-    for post in posts:
-        post_dict[post["post_id"]] = Post(post)
-    return post_dict
+        except MastodonError as e:
+            logger.debug(f"Could not look up posts in batch, looking up one at a time: {e}")
+        for post_id in batch:
+            try:
+                mastodon.status(post_id)
+            except MastodonNotFoundError:
+                deleted.add(post_id)
+            except Exception as e:
+                logger.error(f"Could not check if post {post_id} has been deleted: {e}")
+    return deleted
 
 
 # Changing usernames in post according to settings
@@ -0,0 +1,227 @@
+import json, time, traceback, arrow
+from urllib.parse import urlencode
+from websockets.sync.client import connect
+from websockets.exceptions import ConnectionClosed, InvalidHandshake
+from mastodon import StreamListener, MastodonError
+from settings import settings
+from settings.paths import cursor_path
+from main.functions import logger, cleanup
+from main.connections import bsky_connect, mastodon_connect
+from main.db import database
+from main.feed_cursor import cursor
+from main.outbox import outbox
+from main.post import Post
+from input import bluesky, mastodon
+from input.fetch import get_posts, get_deleted, get_queues
+from output.send import send_posts, delete_posts
+
+# Collections in the stream that are crossposted
+post_collection = "app.bsky.feed.post"
+repost_collection = "app.bsky.feed.repost"
+
+
+# Streaming posts from the input source as they are made, instead of reading the feed of the account every run interval.
+def stream():
+    if settings.input_source == "bluesky":
+        stream_bluesky()
+    elif settings.input_source == "mastodon":
+        stream_mastodon()
+    else:
+        logger.error(f"Streaming is not available with {settings.input_source} as input source.")
+
+
+# Jetstream sends every change made to the account as a json event. Every event has a timestamp in microseconds,
+# which is stored along with the high-water mark of the feed, so that the stream can be resumed where it left off.
+def stream_bluesky():
+    bsky = bsky_connect()
+    if not bsky:
+        logger.error("Could not connect to Bluesky.")
+        return
+    did = bsky.me.did
+    time_us = cursor.position.get("time_us") if cursor.position else None
+    # Without a position in the stream, the feed is read the regular way first so that nothing posted since
+    # the last run is missed. The stream is then started from before the feed was read, and anything found
+    # twice is already in the database the second time.
+    caught_up = bool(time_us)
+    if caught_up:
+        # The posts crossposted within the delete window are only candidates for deletion until they are checked. Since
+        # the stream is resumed from where it left off, deletions made since are found among its events instead.
+        database.deleted = set()
+    else:
+        time_us = arrow.utcnow().int_timestamp * 1000000
+    wait = 1
+    while True:
+        try:
+            if not caught_up:
+                catch_up()
+                caught_up = True
+            with connect(get_url(did, time_us)) as websocket:
+                logger.info("Connected to Jetstream, waiting for posts.")
+                wait = 1
+                for message in websocket:
+                    event = json.loads(message)
+                    time_us = event["time_us"]
+                    try:
+                        handle_event(bsky, event)
+                    except Exception as e:
+                        logger.error(f"Could not handle event from Jetstream: {e}")
+                        logger.debug(traceback.format_exc())
+            logger.warning(f"Jetstream closed the connection. Reconnecting in {wait} seconds.")
+        except (ConnectionClosed, InvalidHandshake, OSError) as e:
+            logger.warning(f"Lost connection to Jetstream: {e}. Reconnecting in {wait} seconds.")
+        except Exception as e:
+            logger.error(f"Could not read posts from Bluesky: {e}. Trying again in {wait} seconds.")
+            logger.debug(traceback.format_exc())
+        time.sleep(wait)
+        wait = min(wait * 2, 300)
+
+
+def get_url(did, time_us):
+    parameters = [
+        ("wantedDids", did),
+        ("wantedCollections", post_collection),
+        ("wantedCollections", repost_collection),
+        ("cursor", time_us)
+    ]
+    return f"{settings.jetstream_url}?{urlencode(parameters)}"
+
+
+# Turning an event from the stream into a post, or a deletion, and sending it on
+def handle_event(bsky, event):
+    logger.trace(event)
+    position = dict(cursor.position or {})
+    post_id = None
+    posts = []
+    commit = event.get("commit")
+    if event["kind"] == "commit" and commit["collection"] in [post_collection, repost_collection]:
+        uri = f"at://{event['did']}/{commit['collection']}/{commit['rkey']}"
+        status = None
+        if commit["operation"] == "create" and commit["collection"] == post_collection:
+            status = bluesky.get_stream_status(bsky, uri)
+        elif commit["operation"] == "create":
+            status = bluesky.get_stream_status(bsky, commit["record"]["subject"]["uri"], commit["record"]["createdAt"])
+        elif commit["operation"] == "delete" and commit["collection"] == post_collection:
+            deleted_id = database.find_uri(uri)
+            if deleted_id:
+                mark_deleted(deleted_id)
+        if status:
+            post_id = status.post.cid
+            position = bluesky.get_position(status)
+            post_info = bluesky.parse_status(bsky, status)
+            if post_info:
+                posts = [Post(post_info)]
+    position["time_us"] = event["time_us"]
+    cursor.seen(post_id, position)
+    if posts or database.deleted:
+        process(posts)
+    else:
+        cursor.save(cursor_path, outbox.resolved)
+
+
+# The user stream of Mastodon contains the home timeline of the account as well, so only statuses posted by the
+# account itself are crossposted. Whenever the connection is lost, the timeline is read the regular way from the
+# high-water mark, so that nothing posted while disconnected is missed.
+def stream_mastodon():
+    connection = mastodon_connect()
+    if not connection:
+        logger.error("Could not connect to Mastodon.")
+        return
+    listener = None
+    wait = 1
+    while True:
+        connected_at = time.time()
+        # The instance being down is the usual reason for the stream to be lost, so reading the timeline
+        # can fail as well, and is tried again along with the stream.
+        try:
+            if not listener:
+                listener = MastodonListener(connection.me()["id"])
+            catch_up()
+            logger.info("Connected to Mastodon stream, waiting for posts.")
+            connection.stream_user(listener)
+            logger.warning(f"Mastodon closed the stream. Reconnecting in {wait} seconds.")
+        except MastodonError as e:
+            logger.warning(f"Lost connection to Mastodon stream: {e}. Reconnecting in {wait} seconds.")
+        except Exception as e:
+            logger.error(f"Could not read posts from Mastodon: {e}. Trying again in {wait} seconds.")
+            logger.debug(traceback.format_exc())
+        # Only waiting longer if the connection was lost right away
+        if time.time() - connected_at > 60:
+            wait = 1
+        time.sleep(wait)
+        wait = min(wait * 2, 300)
+
+
+class MastodonListener(StreamListener):
+    def __init__(self, user_id):
+        super().__init__()
+        self.user_id = user_id
+
+    def on_update(self, status):
+        self.handle_status(status)
+
+    # Edits can't be carried over to posts that have already been crossposted, but a status that has not
+    # yet been crossposted is sent in its edited form. Edited statuses are older than the high-water mark, and so
+    # don't move it.
+    def on_status_update(self, status):
+        self.handle_status(status, edit = True)
+
+    def on_delete(self, status_id):
+        try:
+            if mark_deleted(str(status_id)):
+                process([])
+        except Exception as e:
+            logger.error(f"Could not handle deleted status {status_id}: {e}")
+            logger.debug(traceback.format_exc())
+
+    def handle_status(self, status, edit = False):
+        if str(status.account.id) != str(self.user_id):
+            return
+        try:
+            if not edit:
+                cursor.seen(str(status.id), {"id": str(status.id)})
+            post_info = mastodon.parse_status(status, self.user_id)
+            process([Post(post_info)] if post_info else [])
+        except Exception as e:
+            logger.error(f"Could not handle status {status.id}: {e}")
+            logger.debug(traceback.format_exc())
+
+
+# Reading the feed the regular way, so that nothing posted or deleted while the stream was not connected is missed.
+# If reading fails, the posts read before the error are read again next time, and the deletion candidates are checked
+# again as well.
+def catch_up():
+    try:
+        send_posts(get_posts())
+        get_deleted()
+        process([])
+    except Exception:
+        cursor.reset()
+        database.read_deleted()
+        raise
+
+
+# Posts are only deleted if they were crossposted within the delete window, just like when polling.
+# Returns True if the post is to be deleted.
+def mark_deleted(id):
+    if not settings.cross_delete:
+        return False
+    entry = database.get_entry(id, archived = False)
+    if not entry or not entry.dated or entry.created < arrow.utcnow().shift(hours = -settings.delete_window).int_timestamp:
+        return False
+    logger.info(f"Post {id} was deleted.")
+    database.deleted.add(id)
+    return True
+
+
+# Sending posts and deletions, and saving the changes. Since the stream never finishes a run, the database
+# is backed up at most once an hour instead of after every run.
+def process(posts):
+    send_posts(get_queues(posts))
+    delete_posts()
+    database.deleted = set()
+    database.save()
+    cursor.save(cursor_path, outbox.resolved)
+    cleanup()
+    if not hasattr(process, "_last_backup") or process._last_backup < arrow.utcnow().shift(hours = -1):
+        database.backup().join()
+        process._last_backup = arrow.utcnow()
@@ -0,0 +1,143 @@
+import gzip, json, os, glob, threading, arrow
+from settings.paths import backup_path, database_path, journal_path, archive_path, sqlite_path
+from settings import settings
+from main.functions import logger, atomic_write
+from main.entry import Entry
+from main.storage import JournalStorage, SqliteStorage, get_key
+
+# A full backup contains every post in the database, compressed. Between full backups, the posts that changed
+# during each run are appended to a delta file, so that restoring means reading the full backup and then
+# replaying the delta on top of it. Both files are stored as json lines in the same format as the database journal.
+full_backup_path = f"{backup_path}.gz"
+delta_path = f"{backup_path}.delta.gz"
+# Information about the last full backup, so that the backup files never have to be read to check them.
+meta_path = f"{backup_path}.meta"
+
+
+# Starting a backup in a background thread. The changes made during the run are turned into journal records
+# right away, so that the background thread doesn't need to read the database while it is being changed.
+def start(storage, post_list, changed):
+    records = []
+    for key in changed:
+        if key in post_list:
+            records.append(json.dumps({"op": "set", "entry": post_list[key].to_dict()}) + "\n")
+        else:
+            records.append(json.dumps({"op": "remove", "key": key}) + "\n")
+    thread = threading.Thread(target=backup, args=(storage, post_list, records), name="backup")
+    thread.start()
+    return thread
+
+
+def backup(storage, post_list, records):
+    try:
+        meta = read_meta()
+        if not meta or not os.path.isfile(full_backup_path) \
+            or arrow.get(meta["full"]) < arrow.utcnow().shift(days = -settings.backup_full_interval):
+            full_backup(storage, post_list, meta)
+        elif records:
+            delta_backup(records)
+        remove_old_backups()
+    except Exception as e:
+        logger.error(f"Failed to back up database: {e}")
+
+
+# Writing every post to a new full backup. If the database contains fewer posts than it did at the last full
+# backup, it means something has probably gone wrong, and the previous backup is kept as a dated file so that
+# it can be recovered later.
+def full_backup(storage, post_list, meta):
+    logger.info("Taking full backup of database")
+    temp_path = f"{full_backup_path}.tmp"
+    # Posts are counted by key, so that a post found more than once is only counted once
+    keys = set()
+    with gzip.open(temp_path, "wt") as file:
+        for entry in storage.export(post_list):
+            file.write(json.dumps({"op": "set", "entry": entry.to_dict()}) + "\n")
+            keys.add(get_key(entry))
+    count = len(keys)
+    if meta and count < meta["count"] and os.path.isfile(full_backup_path):
+        date = arrow.utcnow().format("YYMMDD")
+        os.replace(full_backup_path, f"{backup_path}_{date}.gz")
+        if os.path.isfile(delta_path):
+            os.replace(delta_path, f"{backup_path}_{date}.delta.gz")
+        logger.error(f"Previous backup contains more entries ({meta['count']}) than current live database ({count}), backup saved")
+    os.replace(temp_path, full_backup_path)
+    if os.path.isfile(delta_path):
+        os.remove(delta_path)
+    atomic_write(meta_path, [json.dumps({"full": arrow.utcnow().int_timestamp, "count": count})])
+    logger.info(f"Full backup of {count} posts taken")
+
+
+# Appending the posts changed this run to the delta file
+def delta_backup(records):
+    with gzip.open(delta_path, "at") as file:
+        file.writelines(records)
+    logger.info(f"Backed up {len(records)} changed posts")
+
+
+# Removing dated backups older than the backup retention
+def remove_old_backups():
+    if not settings.backup_retention:
+        return
+    limit = arrow.utcnow().shift(days = -settings.backup_retention)
+    for path in glob.glob(f"{backup_path}_*"):
+        try:
+            date = arrow.get(os.path.basename(path).split("_")[-1].split(".")[0], "YYMMDD")
+        except Exception:
+            continue
+        if date < limit:
+            logger.info(f"Removing old backup {path}")
+            os.remove(path)
+
+
+# Reading the posts in a full backup, and replaying the changes in the delta file taken along with it on top
+def read_backup(path):
+    entries = {}
+    for backup_file in [path, path[:-len(".gz")] + ".delta.gz"]:
+        if not os.path.isfile(backup_file):
+            continue
+        try:
+            with gzip.open(backup_file, "rt") as file:
+                for line in file:
+                    record = json.loads(line)
+                    if record["op"] == "remove":
+                        entries.pop(record["key"], None)
+                        continue
+                    entry = Entry.from_dict(record["entry"])
+                    entries[get_key(entry)] = entry
+        except (EOFError, OSError, ValueError) as e:
+            # A backup that was interrupted while being written can still be read up until that point
+            logger.warning(f"Could not read entire backup {backup_file}: {e}")
+    return entries
+
+
+# Replacing the database with the posts in a backup. The database files in use are kept with the ending
+# "_replaced", in case anything goes wrong. This is run on its own through restore.py, never while crossposting.
+def restore(path = full_backup_path):
+    if not os.path.isfile(path):
+        logger.error(f"Backup {path} not found.")
+        return False
+    entries = read_backup(path)
+    logger.info(f"Restoring {len(entries)} posts from {path}")
+    # The write-ahead log of SQLite belongs to the database file, so it is renamed along with it
+    replaced = [(file, f"{file}_replaced") for file in [database_path, journal_path, archive_path, sqlite_path]]
+    replaced += [(f"{sqlite_path}{ending}", f"{sqlite_path}_replaced{ending}") for ending in ["-wal", "-shm"]]
+    for database_file, replaced_file in replaced:
+        if os.path.exists(database_file):
+            os.replace(database_file, replaced_file)
+    if settings.database_backend == "sqlite":
+        SqliteStorage().write_many(entries.values())
+    else:
+        JournalStorage().compact(entries)
+    logger.info(f"Restored {len(entries)} posts.")
+    return True
+
+
+def read_meta():
+    if not os.path.isfile(meta_path):
+        return None
+    try:
+        with open(meta_path, "r") as file:
+            return json.load(file)
+    except Exception as e:
+        logger.error(f"Could not read backup information: {e}")
+        return None
@@ -1,4 +1,4 @@
-import tweepy, traceback, requests
+import tweepy, traceback, requests, threading, functools
 from mastodon import Mastodon
 from atproto import Session, SessionEvent
 from main.functions import logger
@@ -7,7 +7,19 @@ from settings.auth import *
 from settings.paths import session_cache_path
 import  os
 
+# Connections are made the first time they are needed, which can be from the worker threads of several services
+# at once. Connecting holds a lock, so that only one connection is ever made to each service.
+connect_lock = threading.RLock()
+
+def synchronized(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with connect_lock:
+            return function(*args, **kwargs)
+    return wrapper
+
 # Connection to Mastodon API
+@synchronized
 def mastodon_connect():
     try:
         if hasattr(mastodon_connect, "_connection"):
@@ -27,6 +39,7 @@ def mastodon_connect():
 # Twitter has two different API methods, and both are needed.
 
 # Connection to Twitter API
+@synchronized
 def twitter_api_connect():
     if hasattr(twitter_api_connect, "_connection"):
         logger.info("Already connected to Twitter API.")
@@ -37,6 +50,7 @@ def twitter_api_connect():
     return twitter_api_connect._connection
 
 # Connection to Twitter client 
+@synchronized
 def twitter_client_connect():
     if hasattr(twitter_client_connect, "_connection"):
         logger.info("Already connected to Twitter Client.")
@@ -50,6 +64,7 @@ def twitter_client_connect():
     return twitter_client_connect._connection
 
 # Connecting to Bluesky ATProto
+@synchronized
 def bsky_connect():
     if hasattr(bsky_connect, "_connection"):
         logger.info("Already connected to Bluesky.")
@@ -84,21 +99,6 @@ def bsky_connect():
             logger.debug(traceback.format_exc())
         return None
 
-
-
-    
-    # Function for fetching the user a post is a reply to
-    def get_reply_to_user(self, reply):
-        uri = reply.uri
-        username = ""
-        try: 
-            response = self.app.bsky.feed.get_post_thread(params={"uri": uri})
-            username = response.thread.post.author.handle
-        except Exception as e:
-            logger.info("Unable to retrieve reply_to-user of post. Probably a reply to a deleted post.")
-            logger.debug(traceback.format_exc())
-        return username
-    
 # Checks if changes are made to the Bluesky session, meaning the local session file needs to be updated
 def on_session_change(event: SessionEvent, session: Session) -> None:
     logger.info('Session changed:', event, repr(session))
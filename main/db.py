@@ -1,273 +1,348 @@
-import json, os, shutil, arrow
+import os, shutil, time, threading, functools, arrow
 from settings.paths import *
-from main.post import Post
-from main.functions import count_lines, get_outputs
+from main.functions import get_outputs
+from main.post_cache import PostCache
+from main import backup
+from main.storage import JournalStorage, SqliteStorage, get_key
+from main.entry import Entry, services, statuses
 from settings import settings
 from main.functions import logger
 
 
+# Posts are sent from several threads at once, so every method reading or changing the database holds the lock of
+# the database while it runs. The lock is reentrant, since the methods call each other.
+def locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 # Post database class
 class Database():
     # A list of all available services
-    services = ["bluesky", "mastodon", "twitter"]
+    services = services
 
     def __init__(self):
-        # This tracks if there have been updates to the database this run, and if not the database is not resaved at the end
-        self.updated = False
-        # Backup function takes a backup of the database once a day.
-        self.backup()
+        self.lock = threading.RLock()
+        # This tracks which posts have been changed this run. If nothing has changed, the database is not resaved at the end.
+        self.dirty = set()
+        # The cache is tracked separately, since reposts only change the cache.
+        self.cache_dirty = False
+        # Every change to the database is written to storage as soon as it is made, so that no posts are lost
+        # if the run is interrupted.
+        if settings.database_backend == "sqlite":
+            self.storage = SqliteStorage()
+        else:
+            self.storage = JournalStorage()
+        self.outputs = get_outputs()
         self.read_db_file()
         self.read_cache()
-        self.outputs = get_outputs()
+        self.read_deleted()
 
     # Function for getting the corresponding ID for a specific service
+    @locked
     def get_id(self, origin_id, service):
-        if not origin_id or origin_id not in self.post_list:
+        entry = self.get_entry(origin_id)
+        if not entry:
             return None
-        id = self.post_list[origin_id]["services"][service]["id"]
+        id = entry.get_id(service)
         # For bluesky the uri is also needed in order to repost and respond.
         if service == "bluesky": 
-            uri = self.post_list[origin_id]["services"][service]["uri"]
-            return id, uri
+            return id, entry.uri
         return id
 
-    # Reading database.json
+    # Getting the database entry of a post. Posts that have not yet been read this run are looked up in storage.
+    # Archived posts are only looked for if archived is set, as that means reading the entire archive.
+    @locked
+    def get_entry(self, id, archived = True):
+        if not id:
+            return None
+        id = str(id)
+        if id not in self.post_list:
+            entry = self.storage.get(id, archived)
+            if not entry:
+                return None
+            self.post_list[id] = entry
+        return self.post_list[id]
+
+    # Checking if a post exists in the database
+    @locked
+    def exists(self, id, archived = True):
+        return self.get_entry(id, archived) is not None
+
+    # Reading database
     def read_db_file(self):
         logger.info("Reading local database")
         self.post_list = {}
-        db_data = []
-        if not os.path.exists(database_path):
+        # If the SQLite database is empty but there is a database file, the posts are moved over from the file.
+        if settings.database_backend == "sqlite" and self.storage.empty() and os.path.exists(database_path):
+            self.migrate_db()
             return
-        file = open(database_path, 'r')
-        for line in file:
-            try:
-                db_data.append(json.loads(line))
-            except:
-                continue
-        file.close()
-        # If the database doesn't contain the origin field, this means it is
+        db_data = self.storage.load()
+        # If the database could not be read as entries, since it doesn't contain the origin field, this means it is
         # still in the old format and needs to be converted.
-        if db_data and "origin" not in db_data[0]:
+        if db_data and not isinstance(db_data[0], Entry):
             logger.info("Updating database.")
             self.convert_db(db_data)
+            # Storing the converted database right away, so that the journal is never based on the old format
+            self.storage.compact(self.post_list)
             return
-        for line in db_data:
-            # Setting the identifying id to the ID relating to the current input source, unless the post has not been
-            # posted to that service, in which case the ID from the posts origin will be used.
-            if line["services"][settings.input_source]["id"] not in ["skipped", "FailedToPost", "duplicate", ""]:
-                self.post_list[str(line["services"][settings.input_source]["id"])] = line
-            else:
-                self.post_list[str(line["services"][line["origin"]]["id"])] = line
+        for entry in db_data:
+            self.post_list[get_key(entry)] = entry
+
+    # Writing a post to storage after it has been changed
+    @locked
+    def write(self, id):
+        self.dirty.add(str(id))
+        self.storage.write(self.post_list[str(id)])
 
     # Checking if an ID exists in the database (adding if not), and if so, if it has already been posted to all required outputs.
-    def posted(self, id, services = [], uri = None):
-        # If the ID is found it means it has not been deleted, and so it is removed from the array of deleted posts
+    # Posts within the post time limit are never archived, so the archive is only checked if archived is set (for reposts).
+    @locked
+    def posted(self, id, services = [], uri = None, archived = False):
+        # If the ID is found it means it has not been deleted, and so it is removed from the potentially deleted posts
         if id in self.deleted:
             logger.info(f"Removing post {id} from potentially deleted posts.")
-            self.deleted.remove(id)
+            self.deleted.discard(id)
         # If the ID is not in the database, it is added
-        if id not in self.post_list:
+        if not self.exists(id, archived):
             logger.info(f"{id} not found in post list")
             self.add(id, uri)
             return False
         # If no service is given, function checks all active outputs
         if not services:
             services = self.outputs
+        entry = self.get_entry(id)
         for service in services:
             logger.info(f"Checking if {id} has been posted to {service}")
-            logger.debug(self.post_list[id]["services"][service]["id"])
-            if settings.outputs[service] and not self.post_list[id]["services"][service]["id"]:
+            logger.debug(entry.get_id(service))
+            if settings.outputs[service] and not entry.get_id(service):
                 return False
-            if self.post_list[id]["services"][service]["id"] == "FailedToPost":
+            if entry.get_id(service) == "FailedToPost":
                 logger.info(f"{id} has reached error limit for {service}.")
             else:
                 logger.info(f"{id} has already been posted to {service}.")
         return True
     
+    # Finding a recent post by its Bluesky URI. Returns the ID it is stored under, or None if it is not found.
+    @locked
+    def find_uri(self, uri):
+        for key, entry in self.post_list.items():
+            if entry.uri == uri:
+                return key
+        return None
+
+    # Checking if a post has an actual ID for a service, meaning it has been crossposted there
+    @locked
+    def crossposted(self, id, service):
+        entry = self.get_entry(id)
+        return bool(entry and entry.get_id(service) and entry.get_id(service) not in statuses)
+
     # Checking if a post has reached failure limit or has been skipped. 
+    @locked
     def not_posted(self, id, services = []):
         # If no service is given, function checks all active outputs
         if not services:
             services = self.outputs
+        entry = self.get_entry(id)
         # Only if all services has been skipped or failed, returns True
         for service in services:
-            if not self.post_list[id]["services"][service]["id"] or self.post_list[id]["services"][service]["id"] not in ["skipped", "FailedToPost", "duplicate"]:
+            if not entry.get_id(service) or entry.get_id(service) not in statuses:
                 return False
         return True
 
+    # Checking if a post has been dealt with for every active output, meaning it has either been posted or
+    # skipped, or has failed too many times. Posts not in the database have nothing left to be done.
+    @locked
+    def resolved(self, id):
+        entry = self.get_entry(id, archived = False)
+        if not entry:
+            return True
+        return all(entry.get_id(service) for service in self.outputs)
+
     # Adding new ID to database
+    @locked
     def add(self, id, uri = None):
         logger.info("Adding post to database")
-        self.updated = True
-        self.post_list[id] = {
-            "origin": settings.input_source,
-            "services": self.create_entry()
-        }
+        entry = Entry(settings.input_source, arrow.utcnow().int_timestamp)
         # Setting the ID of the post from the input source
-        self.post_list[id]["services"][settings.input_source]["id"] = id
+        entry.set_id(settings.input_source, id)
         # Adding uri if applicable. This only applies for Bluesky
         if uri:
-            self.post_list[id]["services"]["bluesky"]["uri"] = uri
+            entry.uri = uri
         # For any service that is not the input, and not included in active outputs, setting the id to "skipped"
-        for service in self.post_list[id]["services"]:
+        for service in self.services:
             if service != settings.input_source and settings.outputs[service] == False:
-                self.post_list[id]["services"][service]["id"] = "skipped"
+                entry.set_id(service, "skipped")
+        self.post_list[id] = entry
+        self.write(id)
 
     # Removing post from db and cache
+    @locked
     def remove(self, id):
         logger.info(f"Deleting post {id} from database.")
-        del self.post_list[id]
-        del self.cache[id]
+        self.storage.delete(self.get_entry(id))
+        del self.post_list[str(id)]
+        if id in self.cache:
+            del self.cache[id]
+        self.dirty.add(str(id))
+        self.cache_dirty = True
 
     # Updating database and cache when a post is sent
+    @locked
     def update(self, input_id, service, output_id = None, uri = None):
         # For reposts no new output_id is given, only the cache is updated
         if output_id:
-            self.post_list[str(input_id)]["services"][service]["id"] = output_id
+            self.get_entry(input_id).set_id(service, output_id)
         if uri:
-            self.post_list[input_id]["services"][service]["uri"] = uri
+            self.get_entry(input_id).uri = uri
         self.cache[str(input_id)] = arrow.utcnow()
-        self.updated = True
+        self.cache_dirty = True
+        if output_id or uri:
+            self.write(input_id)
+
+    # The number of posts sent within the last hour. The cache is changed by the threads sending posts.
+    @locked
+    def sent_last_hour(self):
+        return len(self.cache)
+
+    # The time a post was last sent, if it was sent within the last hour
+    @locked
+    def last_sent(self, id):
+        return self.cache[id] if id in self.cache else None
 
     # Setting a post for a service to skipped
+    @locked
     def skip(self, id, service):
-        if not self.post_list[str(id)]["services"][service]["id"]:
-            self.updated = True
-            self.post_list[str(id)]["services"][service]["id"] = "skipped"
+        if not self.get_entry(id).get_id(service):
+            self.get_entry(id).set_id(service, "skipped")
+            self.write(id)
 
-    #  Saving database to file
+    # Saving database and cache. Only what has changed during the run is written, and if nothing has changed
+    # nothing is written at all.
+    @locked
     def save(self):
-        logger.info("Saving database")
-        append_write = "w"
-        for id in self.post_list:
-            json_string = json.dumps(self.post_list[id])
-            file = open(database_path, append_write)
-            file.write(json_string + "\n")
-            file.close()
-            append_write = "a"
-        self.save_cache()
+        if not self.dirty and not self.cache_dirty:
+            logger.info("No changes made to database, skipping save.")
+            return
+        start = time.perf_counter()
+        cache_bytes = 0
+        if self.dirty:
+            self.storage.save(self.post_list)
+        if self.cache_dirty:
+            cache_bytes = self.save_cache()
+        duration = time.perf_counter() - start
+        if self.storage.bytes_written is None:
+            logger.info(f"Saved database in {duration:.3f} seconds: {len(self.dirty)} changed posts, {cache_bytes} bytes of cache written.")
+        else:
+            logger.info(f"Saved database in {duration:.3f} seconds: {len(self.dirty)} changed posts, {self.storage.bytes_written + cache_bytes} bytes written.")
 
     # If a post failed to send, increasing the failure counter for that service. If it reaches the max_retries-limit, setting the post ID to "FailedToPost"
+    @locked
     def failed_post(self, id, service):
-        self.post_list[id]["services"][service]["failure"] += 1
-        if self.post_list[id]["services"][service]["failure"] >= settings.max_retries:
-            self.post_list[id]["services"][service]["id"] = "FailedToPost"
+        entry = self.get_entry(id)
+        entry.set_failure(service, entry.get_failure(service) + 1)
+        if entry.get_failure(service) >= settings.max_retries:
+            entry.set_id(service, "FailedToPost")
+        self.write(id)
 
 
     # Reading cache-file
     def read_cache(self):
         logger.info("Reading cache of recent posts.")
-        self.cache = {}
-        # Adding all recent posts to deleted, and removing them when they are confirmed to not be.
-        self.deleted = []
-        timelimit = arrow.utcnow().shift(hours = -1)
-        if not os.path.exists(post_cache_path):
-            logger.info(f"{post_cache_path} not found.")
-            return
-        with open(post_cache_path, 'r') as file:
-            for line in file:
-                try:
-                    post_id = str(line.split(";")[0])
-                    timestamp = int(line.split(";")[1].split(".")[0])
-                    timestamp = arrow.Arrow.fromtimestamp(timestamp)
-                except Exception as e:
-                    logger.error(e)
-                    continue
-                if timestamp > timelimit:
-                    self.cache[post_id] = timestamp
-                    self.deleted.append(post_id)
+        self.cache = PostCache()
+        # Posts that are too old to be kept are dropped from the cache file next time it is saved
+        if self.cache.read(post_cache_path):
+            self.cache_dirty = True
         logger.debug(f"Cache: {self.cache}")
+
+    # Posts crossposted within the delete window might have been deleted from the input source. They are all treated
+    # as potentially deleted, and removed from the set when they are found in the feed or confirmed to still exist.
+    def read_deleted(self):
+        self.deleted = set()
+        if not settings.cross_delete:
+            return
+        since = arrow.utcnow().shift(hours = -settings.delete_window).int_timestamp
+        for entry in self.storage.recent(self.post_list, since):
+            if not entry.dated:
+                continue
+            key = get_key(entry)
+            self.post_list.setdefault(key, entry)
+            if any(self.crossposted(key, service) for service in self.outputs):
+                self.deleted.add(key)
         logger.debug(f"Deleted: {self.deleted}")
 
-    # Saving cache to file
+    # Saving cache to file. Returns the number of bytes written.
     def save_cache(self):
         logger.info("Saving cache.")
         logger.debug(self.cache)
+        self.cache_dirty = False
         if not self.cache:
             if os.path.exists(post_cache_path):
                 os.remove(post_cache_path)
             logger.info("Post cache is empty, removing cache file.")
-            return
+            return 0
         logger.info("Saving post cache.")
-        append_write = "w"
-        for post_id in self.cache:
-            timestamp = str(self.cache[post_id].timestamp())
-            file = open(post_cache_path, append_write)
-            file.write(f"{post_id};{timestamp}\n")
-            file.close()
-            append_write = "a"
+        return self.cache.save(post_cache_path)
 
     # The timelimit specifies the cutoff time for which posts are crossposted. This is usually based on the 
     # post_time_limit in settings, but if overflow_posts is set to "skip", meaning any posts that could
     # not be posted due to the hourly post max limit is to be skipped, then the timelimit is instead set to
     # when the last post was sent.
+    @locked
     def get_post_time_limit(self):
         timelimit = arrow.utcnow().shift(hours = -settings.post_time_limit)
         if settings.overflow_posts != "skip":
             return timelimit
-        for post_id in self.cache:
-            if timelimit < self.cache[post_id]:
-                timelimit = self.cache[post_id]
+        last_sent = self.cache.last_sent()
+        if last_sent and timelimit < last_sent:
+            timelimit = last_sent
         return timelimit
 
-    # Every twelve hours a backup of the database is saved, in case something happens to the live database.
-    # If the live database contains fewer lines than the backup it means something has probably gone wrong,
-    # and before the live database is saved as a backup, the current backup is saved as a new file, so that
-    # it can be recovered later.
+    # Backing up the database in the background, once the work of the run is done. Returns the backup thread,
+    # which should be waited for before exiting. More about how backups are taken in main/backup.py.
+    @locked
     def backup(self):
-        if not os.path.isfile(database_path) or (os.path.isfile(backup_path)
-            and arrow.Arrow.fromtimestamp(os.stat(backup_path).st_mtime) > arrow.utcnow().shift(hours = -24)):
-            return
-        if os.path.isfile(backup_path):
-            if count_lines(backup_path) <= count_lines(database_path):
-                os.remove(backup_path)
-            else:
-                date = arrow.utcnow().format("YYMMDD")
-                os.rename(backup_path, backup_path + "_" + date)
-                logger.error("Current backup file contains more entries than current live database, backup saved")
-        shutil.copyfile(database_path, backup_path)
-        logger.info("Backup of database taken")
+        thread = backup.start(self.storage, self.post_list, self.dirty)
+        # The changes are now part of the backup, so that the next backup only contains changes made after this one
+        self.dirty = set()
+        return thread
 
     # If database is in old format, this function will read it and convert it to the new.
     def convert_db(self, db_data):
         # Making a backup of the old database before converting
         logger.info(f"Backing up database to {database_path}_old before converting.")
         shutil.copyfile(database_path, f"{database_path}_old")
+        now = arrow.utcnow().int_timestamp
         for line in db_data:
             # Since the old format only used bluesky as input, it will always be the origin
-            post = {
-                "origin": "bluesky",
-                "services": self.create_entry()
-            }
+            post = Entry("bluesky", now, dated = False)
             # Entering data from old database
-            post["services"]["bluesky"] = {
-                                            "id": line["skeet"],
-                                            "uri": "",
-                                            "failure": 0
-                                        }
-            post["services"]["twitter"] = {
-                                            "id": line["ids"]["twitter_id"],
-                                            "failure": line["failed"]["twitter"],
-                                        }
-            post["services"]["mastodon"] = {
-                                            "id": line["ids"]["mastodon_id"],
-                                            "failure": line["failed"]["mastodon"],
-                                        }
-            self.post_list[post["services"][settings.input_source]["id"]] = post
+            post.set_id("bluesky", line["skeet"])
+            post.set_id("twitter", line["ids"]["twitter_id"])
+            post.set_failure("twitter", line["failed"]["twitter"])
+            post.set_id("mastodon", line["ids"]["mastodon_id"])
+            post.set_failure("mastodon", line["failed"]["mastodon"])
+            self.post_list[post.get_id(settings.input_source)] = post
 
-    # Dynamically creating empty entry for a post containing every available service
-    def create_entry(self):
-        services = {}
-        for service in self.services:
-            services[service] = {
-                        "id": "",
-                        "failure": 0
-                    }
-            # Bluesky requires both CID and URI to interact with posts.
-            # Bluesky really is needlessly complicated.
-            if service == "bluesky":
-                services[service]["uri"] = ""
-        return services
+    # If the SQLite backend is used with a database file from the regular backend, all posts are moved to SQLite.
+    # The database file is kept with the ending "_migrated", in case anything goes wrong.
+    def migrate_db(self):
+        logger.info(f"Migrating database from {database_path} to {sqlite_path}.")
+        db_data = JournalStorage().load()
+        if db_data and not isinstance(db_data[0], Entry):
+            logger.info("Updating database.")
+            self.convert_db(db_data)
+        else:
+            for entry in db_data:
+                self.post_list[get_key(entry)] = entry
+        self.storage.write_many(self.post_list.values())
+        os.rename(database_path, f"{database_path}_migrated")
+        if os.path.exists(journal_path):
+            os.rename(journal_path, f"{journal_path}_migrated")
+        logger.info(f"Migrated {len(self.post_list)} posts.")
 
 # Initiating database
 database = Database()
\ No newline at end of file
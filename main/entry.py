@@ -0,0 +1,79 @@
+import sys
+
+# A list of all available services
+services = ["bluesky", "mastodon", "twitter"]
+# Values used instead of an ID when a post has not been posted to a service. They are interned, so that
+# every entry refers to the same string instead of holding its own copy.
+statuses = [sys.intern(status) for status in ["skipped", "FailedToPost", "duplicate"]]
+
+# Names of the attributes holding the ID and failure count of each service
+id_fields = {service: f"{service}_id" for service in services}
+failure_fields = {service: f"{service}_failure" for service in services}
+
+
+# A post in the database. Entries are kept in memory for every post read during a run, so instead of the nested
+# dictionaries used in the database file, every value is stored in a fixed slot on a single object.
+class Entry():
+    __slots__ = ["origin", "created", "dated", "uri"] + list(id_fields.values()) + list(failure_fields.values())
+
+    # Posts stored before the creation time was added are given a creation time when they are read, which only
+    # decides when they are archived. They are not dated, and so are never taken for recently crossposted posts.
+    def __init__(self, origin, created, dated = True):
+        self.origin = sys.intern(origin)
+        self.created = created
+        self.dated = dated
+        # Bluesky requires both CID and URI to interact with posts.
+        # Bluesky really is needlessly complicated.
+        self.uri = ""
+        for service in services:
+            setattr(self, id_fields[service], "")
+            setattr(self, failure_fields[service], 0)
+
+    def get_id(self, service):
+        return getattr(self, id_fields[service])
+
+    def set_id(self, service, id):
+        if id in statuses:
+            id = sys.intern(id)
+        setattr(self, id_fields[service], id)
+
+    def get_failure(self, service):
+        return getattr(self, failure_fields[service])
+
+    def set_failure(self, service, failure):
+        setattr(self, failure_fields[service], failure)
+
+    # The ID of the post on the service it was first posted to
+    def origin_id(self):
+        return self.get_id(self.origin)
+
+    # Converting entry to the format used in the database file
+    def to_dict(self):
+        entry = {
+            "origin": self.origin,
+            "created": self.created,
+            "services": {}
+        }
+        if not self.dated:
+            entry["dated"] = False
+        for service in services:
+            entry["services"][service] = {
+                "id": self.get_id(service),
+                "failure": self.get_failure(service)
+            }
+            if service == "bluesky":
+                entry["services"][service]["uri"] = self.uri
+        return entry
+
+    # Creating entry from the format used in the database file
+    @classmethod
+    def from_dict(cls, data, created = None):
+        entry = cls(data["origin"], data.get("created", created), "created" in data and data.get("dated", True))
+        for service in services:
+            entry.set_id(service, data["services"][service]["id"])
+            entry.set_failure(service, data["services"][service]["failure"])
+        entry.uri = data["services"]["bluesky"].get("uri", "")
+        return entry
+
+    def __repr__(self):
+        return f"Entry({self.to_dict()})"
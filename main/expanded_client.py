@@ -6,6 +6,7 @@ from atproto_client.models.languages import DEFAULT_LANGUAGE_CODE1
 from atproto_client.exceptions import LoginRequiredError
 from atproto_client.utils import TextBuilder
 from atproto_client import models
+from main.media import upload_all
 
 # A wrapper class for the atproto client with expanded features
 class ExpandedClient(Client):
@@ -26,6 +27,25 @@ class ExpandedClient(Client):
         self._reset = self.response.headers.get("RateLimit-Reset")
 
         return self.response
+
+    # Getting the feed of an account as the json it is sent as, without turning it into models
+    def get_author_feed_raw(self, params):
+        response = self.invoke_query(
+            "app.bsky.feed.getAuthorFeed",
+            params = models.AppBskyFeedGetAuthorFeed.Params(**params),
+            output_encoding = "application/json"
+        )
+        return response.content
+
+    # Getting the handles of the authors of several posts, looking up 25 posts at a time.
+    # Posts that can't be found, for example because they have been deleted, are left out.
+    def get_post_authors(self, uris):
+        authors = {}
+        for i in range(0, len(uris), 25):
+            response = self.app.bsky.feed.get_posts({"uris": uris[i:i + 25]})
+            for post in response.posts:
+                authors[post.uri] = post.author.handle
+        return authors
     
     def send_post(
         self,
@@ -149,7 +169,7 @@ class ExpandedClient(Client):
             diff = len(images) - len(image_aspect_ratios)
             aligned_image_aspect_ratios = image_aspect_ratios + [None] * diff
 
-        uploads = [self.upload_blob(image) for image in images]
+        uploads = upload_all(self.upload_blob, images)
         embed_images = [
             models.AppBskyEmbedImages.Image(alt=alt, image=upload.blob, aspect_ratio=aspect_ratio)
             for alt, upload, aspect_ratio in zip(image_alts, uploads, aligned_image_aspect_ratios)
@@ -0,0 +1,76 @@
+import os, json
+from collections import deque
+from settings.paths import cursor_path
+from settings import settings
+from main.functions import logger, atomic_write
+
+
+# Keeping track of how far into the feed of the input source the crossposter has come. The high-water mark is
+# the position of the newest post in the feed that has been dealt with, and the feed is only read up until that
+# point, so that a run without new posts only needs a single request. The mark is only moved past posts that
+# have been dealt with completely, so that posts that failed or were held back by the hourly limit are read again.
+class FeedCursor():
+    def __init__(self, source):
+        self.source = source
+        # The high-water mark of every input source, so that changing the input source doesn't lose the others
+        self.sources = {}
+        self.position = None
+        # Posts read from the feed this run, with their position in the feed, oldest first
+        self.items = deque()
+        # Posts that were sent or held back this run, and so need to be checked before the mark passes them
+        self.pending = set()
+
+    def read(self, path):
+        if not os.path.exists(path):
+            logger.info(f"{path} not found.")
+            return
+        try:
+            with open(path, 'r') as file:
+                self.sources = json.load(file)
+        except Exception as e:
+            logger.error(f"Could not read feed cursor: {e}")
+            return
+        self.position = self.sources.get(self.source)
+        logger.debug(f"High-water mark: {self.position}")
+
+    # Recording a post read from the feed. Posts are expected in the order they were posted, oldest first.
+    def seen(self, post_id, position):
+        self.items.append((post_id, position))
+
+    # Marking a post as sent or held back, meaning the mark can't be moved past it until it has been resolved
+    def hold(self, post_id):
+        self.pending.add(post_id)
+
+    # Moving the mark forward past every post that has been dealt with, stopping at the first post that has not.
+    # The posts after that are kept, so that the mark can be moved past them once it has been dealt with.
+    # Returns True if the mark was moved.
+    def advance(self, resolved):
+        position = self.position
+        while self.items:
+            post_id, item_position = self.items[0]
+            if post_id in self.pending and not resolved(post_id):
+                logger.info(f"Post {post_id} has not been resolved, feed will be read from here next run.")
+                break
+            position = item_position
+            self.items.popleft()
+            self.pending.discard(post_id)
+        moved = position != self.position
+        self.position = position
+        return moved
+
+    # Forgetting the posts read since the mark was last moved, so that the mark stays where it is until they are read again
+    def reset(self):
+        self.items.clear()
+        self.pending.clear()
+
+    # Moving the mark and saving it to file if it was moved
+    def save(self, path, resolved):
+        if not self.advance(resolved):
+            return 0
+        self.sources[self.source] = self.position
+        logger.info(f"Saving high-water mark {self.position}")
+        return atomic_write(path, [json.dumps(self.sources)])
+
+
+cursor = FeedCursor(settings.input_source)
+cursor.read(cursor_path)
@@ -1,4 +1,4 @@
-import  os, shutil, re, sys, traceback, requests, math
+import  os, shutil, re, sys, traceback, math
 from loguru import logger
 from PIL import Image, ImageSequence
 from settings.auth import *
@@ -56,6 +56,28 @@ def cleanup():
             logger.debug(traceback.format_exc())
 
 
+# Writing a file through a temporary file which then replaces the original. The data is synced to disk before the
+# file is replaced, so that an interrupted write never leaves a half written file. Returns the number of bytes written.
+def atomic_write(path, lines):
+    temp_path = f"{path}.tmp"
+    size = 0
+    with open(temp_path, "wb") as file:
+        for line in lines:
+            data = line.encode("utf-8")
+            file.write(data)
+            size += len(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+    # Syncing the folder as well, so that the replacement itself is stored
+    try:
+        folder = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+        os.fsync(folder)
+        os.close(folder)
+    except OSError:
+        pass
+    return size
+
 # Function for counting lines in a file
 def count_lines(file):
     count = 0;
@@ -209,7 +231,9 @@ def get_tlds():
     if hasattr(get_tlds, "_data"):
         return get_tlds._data
     logger.info("Getting list of TLDs from IANA.")
-    resp = requests.get("https://data.iana.org/TLD/tlds-alpha-by-domain.txt")
+    # Imported here, since the HTTP client uses the logger set up in this module
+    from main.http import http_client
+    resp = http_client.get("https://data.iana.org/TLD/tlds-alpha-by-domain.txt")
     get_tlds._data = resp.content.decode('utf-8').lower().split("\n")[1:-1]
     return get_tlds._data
         
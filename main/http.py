@@ -0,0 +1,82 @@
+import threading, httpx
+from urllib.parse import urlsplit
+from settings import settings
+from main.functions import logger
+
+# HTTP/2 is only available if the h2 package is installed
+try:
+    import h2
+    http2_available = True
+except ImportError:
+    http2_available = False
+
+
+# Every download that is not made through the API client of a service goes through this one client. Connections are
+# kept open and reused, so that repeated downloads from the same host, such as images from the same CDN, do not
+# connect again every time. Requests have a timeout by default, and no more than http_host_connections requests
+# are made to the same host at the same time. The bytes downloaded from each host are counted.
+class HttpClient():
+    def __init__(self):
+        http2 = settings.http2 and http2_available
+        if settings.http2 and not http2_available:
+            logger.warning("HTTP/2 requires the h2 package to be installed. Using HTTP/1.1 instead.")
+        self.client = httpx.Client(
+            http2 = http2,
+            follow_redirects = True,
+            timeout = settings.http_timeout,
+            limits = httpx.Limits(max_keepalive_connections = 20, keepalive_expiry = 30)
+        )
+        self.lock = threading.Lock()
+        self.hosts = {}
+        # Requests made and bytes downloaded, by host
+        self.stats = {}
+
+    # Getting the semaphore limiting the requests made to a host at the same time
+    def host_limit(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(settings.http_host_connections)
+                self.stats[host] = {"requests": 0, "bytes": 0}
+            return self.hosts[host]
+
+    def count(self, host, size):
+        with self.lock:
+            self.stats[host]["requests"] += 1
+            self.stats[host]["bytes"] += size
+
+    # Getting the full response of a url. The response is returned whatever its status code.
+    def get(self, url, timeout = httpx.USE_CLIENT_DEFAULT):
+        host = urlsplit(url).hostname
+        with self.host_limit(host):
+            response = self.client.get(url, timeout = timeout)
+        self.count(host, len(response.content))
+        return response
+
+    # Getting a web page, reading no more than max_size bytes of it. Returns the url the page was found at after
+    # redirects, and the page as text, or an empty string if the url is not a web page.
+    def get_page(self, url, max_size):
+        host = urlsplit(url).hostname
+        content = b""
+        with self.host_limit(host), self.client.stream("GET", url) as response:
+            if "html" in response.headers.get("Content-Type", ""):
+                for chunk in response.iter_bytes():
+                    content += chunk
+                    if len(content) >= max_size:
+                        break
+            final_url = str(response.url)
+            encoding = response.charset_encoding or "utf-8"
+        self.count(host, len(content))
+        return final_url, content[:max_size].decode(encoding, errors = "replace")
+
+    # Logging how much has been downloaded from each host
+    def report(self):
+        with self.lock:
+            total = sum(stats["bytes"] for stats in self.stats.values())
+            requests = sum(stats["requests"] for stats in self.stats.values())
+            for host, stats in self.stats.items():
+                logger.debug(f"Downloaded {stats['bytes']} bytes from {host} in {stats['requests']} requests.")
+        if requests:
+            logger.info(f"Downloaded {total} bytes in {requests} requests.")
+
+
+http_client = HttpClient()
@@ -0,0 +1,117 @@
+import random, string, time, threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from PIL import Image
+from settings import settings
+from settings.paths import image_path
+from main.functions import logger
+from main.http import http_client
+
+# Media is downloaded in the background as soon as a post is known to need it, so that downloads overlap with each
+# other and with reading the rest of the feed. Nothing waits for a download until the file is needed for posting.
+pool = ThreadPoolExecutor(max_workers = settings.media_workers, thread_name_prefix = "media")
+# The files of a post are uploaded to a service at the same time. The pool is shared by all services.
+upload_pool = ThreadPoolExecutor(max_workers = settings.upload_workers, thread_name_prefix = "upload")
+
+# The number of files downloaded and the total time spent downloading them, across all threads
+stats = {"files": 0, "seconds": 0}
+stats_lock = threading.Lock()
+
+
+def random_filename():
+    return ''.join(random.choice(string.ascii_lowercase) for i in range(10))
+
+
+# Starting the download of every media item of a post. Returns a list of downloads to be collected with get_download.
+def start_downloads(media):
+    if media["type"] == "image":
+        return [pool.submit(timed, download_image, image) for image in media["items"]]
+    elif media["type"] == "video":
+        return [pool.submit(timed, download_video, video) for video in media["items"]]
+    return []
+
+
+# Waiting for a download to finish. If the download failed, the error is raised, so that the post fails and is
+# tried again instead of being sent without some of its media.
+def get_download(download):
+    try:
+        return download.result()
+    except Exception as e:
+        logger.error(f"Failed to download media: {e}")
+        raise
+
+
+# Uploading every item with the given function at the same time, returning the results in the order of the items.
+# If an upload fails, its error is raised once all the uploads have finished, just as if they were done one by one.
+def upload_all(function, items):
+    return get_uploads([upload_pool.submit(function, item) for item in items])
+
+
+# Waiting for uploads that have already been started, returning their results in order
+def get_uploads(uploads):
+    wait(uploads)
+    return [upload.result() for upload in uploads]
+
+
+def timed(function, item):
+    start = time.perf_counter()
+    try:
+        return function(item)
+    finally:
+        with stats_lock:
+            stats["files"] += 1
+            stats["seconds"] += time.perf_counter() - start
+
+
+# Function for getting included images.
+def download_image(image):
+    # Attempting to get the correct file ending from the image url.
+    # This is not strictly necessary so if it fails the image is downloaded with no file ending.
+    file_ending = f".{image['url'].split('?')[0].split('.')[-1]}"
+    if len(file_ending) > 5:
+        file_ending = f".{file_ending.split('@')[-1]}"
+    if len(file_ending) > 5:
+        file_ending = ""
+    filename = f"{image_path}{random_filename()}{file_ending}"
+    logger.info(f"Downloading image from {image['url']} as {filename}")
+    # Downloading fullsize version of image
+    response = http_client.get(image['url'], timeout = settings.media_timeout)
+    response.raise_for_status()
+    with open(filename, 'wb') as file:
+        file.write(response.content)
+    # Checking the image type, mostly to see if it is a gif.
+    with Image.open(filename) as local_image:
+        image_type = local_image.format
+    return {
+        "filename": filename,
+        "alt": image["alt"],
+        "type": image_type
+    }
+
+
+# Function for getting included video.
+def download_video(video):
+    filename = image_path + random_filename() + ".mp4"
+    response = http_client.get(video["url"], timeout = settings.media_timeout)
+    if response.status_code != 200:
+        logger.error("Failed to download: %s." % response.text)
+        return None
+    if 'video' not in response.headers.get('Content-Type', ''):
+        logger.error("Response is not a valid video file.")
+        return None
+    with open(filename, 'wb') as f:
+        f.write(response.content)
+    logger.info("Video successfully downloaded to %s." % filename)
+    return {
+        "filename": filename,
+        "alt": video["alt"],
+        "type": "MP4"
+    }
+
+
+# Logging how long fetching and sending posts took in total, compared to the time spent downloading media.
+# With downloads running in parallel, the time spent downloading can be longer than the time it all took.
+def report_downloads(wall_time):
+    if not stats["files"]:
+        return
+    http_client.report()
+    logger.info(f"Fetched posts in {wall_time:.2f} seconds. Downloading {stats['files']} media files took {stats['seconds']:.2f} seconds in total.")
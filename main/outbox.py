@@ -0,0 +1,178 @@
+import os, json, threading, arrow
+from settings.paths import outbox_path
+from main.functions import logger, atomic_write
+from main.db import database
+from main.entry import statuses
+from main.post import Post, PostView
+
+
+# Posts on their way to a service are kept in the outbox until they have been delivered. Every post is stored with
+# the text rendered for the service and how far the delivery has come, so that a post that failed or was interrupted
+# is picked up again next run where it stopped, without reading it from the input source again.
+# The state of a delivery is one of "pending", "uploading-media", "posted-chunk-N", "done" and "failed".
+# Changes are appended to the outbox file as they are made, and the file is rewritten with only the posts left in it
+# when it is read at the start of the next run.
+class Outbox():
+    def __init__(self):
+        self.items = {}
+        self.file = None
+        # Posts are sent from several threads at once
+        self.lock = threading.RLock()
+
+    def read(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as file:
+                for line in file:
+                    # Outboxes written before changes were appended hold a single list of every post
+                    if line.startswith("["):
+                        for record in json.loads(line):
+                            self.items[(record["id"], record["service"])] = record
+                        continue
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        # A partially written last line is a change that was interrupted before it was stored
+                        continue
+                    self.replay(change)
+        except Exception as e:
+            logger.error(f"Could not read outbox: {e}")
+            return
+        atomic_write(path, [json.dumps(self.added(record)) + "\n" for record in self.items.values()])
+        logger.info(f"{len(self.items)} posts in outbox")
+
+    def added(self, record):
+        return {"op": "add", "id": record["id"], "service": record["service"], "record": record}
+
+    def replay(self, change):
+        key = (change["id"], change["service"])
+        if change["op"] == "add":
+            self.items[key] = change["record"]
+        elif change["op"] == "update" and key in self.items:
+            self.items[key].update(change["fields"])
+        elif change["op"] == "remove":
+            self.items.pop(key, None)
+
+    # Storing a change by appending it to the outbox file. The change is flushed to disk before returning,
+    # so that a post that is interrupted after this is resumed from where it was.
+    def write(self, change):
+        with self.lock:
+            if not self.file:
+                self.file = open(outbox_path, 'a')
+            self.file.write(json.dumps(change) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def has(self, post_id, service):
+        return (post_id, service) in self.items
+
+    # Checking if a post has been dealt with, which it has if it is left to the outbox to deliver
+    def resolved(self, post_id):
+        return any(id == post_id for id, service in self.items) or database.resolved(post_id)
+
+    # Adding a post to the outbox before it is sent. Reposts are not added, since they are only sent if they are recent.
+    # Only the fields a post is made from are stored. The repost field of a post read from Mastodon is the reblogged
+    # status itself, which is only needed to know if the post is a repost.
+    def add(self, item):
+        if item.type == "repost" or self.has(item.id, item.service):
+            return
+        info = item.post.info
+        post = {
+            "post_id": info["post_id"],
+            "text": info["text"],
+            "urls": list(info["urls"]),
+            "tags": list(info["tags"]),
+            "reply_id": info["reply_id"],
+            "quote_id": info["quote_id"],
+            "quote_url": info["quote_url"],
+            "media": info["media"],
+            "sensitive": info["sensitive"],
+            "language": info["language"],
+            "privacy": info["privacy"],
+            "repost": bool(info["repost"]),
+            "created_at": info["created_at"].isoformat()
+        }
+        item.text_content()
+        with self.lock:
+            record = {
+                "id": item.id,
+                "service": item.service,
+                "type": item.type,
+                "post": post,
+                "text": item.text,
+                "state": item.state,
+                "chunks_posted": item.chunks_posted
+            }
+            self.items[(item.id, item.service)] = record
+            self.write(self.added(record))
+
+    def update(self, item, state):
+        item.state = state
+        with self.lock:
+            record = self.items.get((item.id, item.service))
+            if not record:
+                return
+            fields = {
+                "state": state,
+                "chunks_posted": item.chunks_posted,
+                "text": item.text
+            }
+            record.update(fields)
+            self.write({"op": "update", "id": item.id, "service": item.service, "fields": fields})
+
+    def posted_chunk(self, item, chunk):
+        item.chunks_posted = chunk
+        self.update(item, f"posted-chunk-{chunk}")
+
+    # Removing a post from the outbox once it has been delivered, or will never be. If it is to be tried again
+    # it is marked as failed and left for the next run.
+    def finish(self, item):
+        if not self.has(item.id, item.service):
+            return
+        entry = database.get_entry(item.id)
+        if item.state == "done" or not entry or entry.get_id(item.service) in statuses:
+            self.remove(item)
+        else:
+            logger.info(f"Post {item.id} was not delivered to {item.service}, it will be retried next run.")
+            self.update(item, "failed")
+
+    # Removing a post that will never be delivered, without trying to send it
+    def remove(self, item):
+        self.discard(item.id, item.service)
+
+    def discard(self, post_id, service):
+        with self.lock:
+            if self.items.pop((post_id, service), None):
+                self.write({"op": "remove", "id": post_id, "service": service})
+
+    # Going through the posts left in the outbox, in the order they were added, and handing them on the same
+    # way as posts read from the input. Posts that are now outside the post time limit are given up on.
+    def resume(self):
+        time_limit = database.get_post_time_limit()
+        posts = {}
+        for key, record in list(self.items.items()):
+            if arrow.get(record["post"]["created_at"]) < time_limit:
+                logger.info(f"Post {record['id']} was not delivered to {record['service']} within the post time limit.")
+                self.discard(*key)
+                continue
+            posts.setdefault(record["id"], []).append(record)
+        for post_id, records in posts.items():
+            info = dict(records[0]["post"])
+            info["created_at"] = arrow.get(info["created_at"])
+            post = Post(info)
+            queues = {}
+            for record in records:
+                logger.info(f"Resuming delivery of {post_id} to {record['service']} from state {record['state']}")
+                item = PostView(post, record["service"], record["type"])
+                item.text = record["text"]
+                item.state = record["state"]
+                item.chunks_posted = record["chunks_posted"]
+                if info["media"] and not item.chunks_posted:
+                    post.get_media()
+                queues[record["service"]] = item
+            yield queues
+
+
+outbox = Outbox()
+outbox.read(outbox_path)
@@ -1,8 +1,6 @@
-from copy import deepcopy
+from types import MappingProxyType
 from main.functions import logger, split_text
-from settings.paths import image_path
-from PIL import Image
-import random, string, urllib, requests
+from main.media import start_downloads, get_download
 import settings.settings as settings
 from main.service_parameters import service_parameters
 
@@ -24,11 +22,17 @@ class Post():
         # }
 
 
+    # A post is shared by the queues of every service it is sent to, and so is never changed once created.
+    # What differs between services is kept in a PostView instead.
     def __init__(self, post_info):
         logger.debug(f"Generating post based on {post_info}")
-        self.info = post_info
-        # Empty list for putting media in
-        self.media = []
+        info = dict(post_info)
+        info["urls"] = tuple(info["urls"])
+        info["tags"] = tuple(info["tags"])
+        self.info = MappingProxyType(info)
+        # Media is added once it has been downloaded
+        self.downloads = []
+        self._media = ()
 
     # Takes post info and generated test posts fit for a specific service.
     def text_content(self, service, addition = ""):
@@ -37,7 +41,7 @@ class Post():
             return [""]
         # Making a copy of the text and then shortening the URL according to the shortening rules for the specific service
         # Allowing for an addiction to be made, since sometimes Mastodon adds a quoted post as a url
-        text = deepcopy(self.info["text"]) + addition
+        text = self.info["text"] + addition
         text = self.shorten_urls(text, service)
         # Turning string into a list of strings short enough to fit the target service
         posts = split_text(text, service)
@@ -51,69 +55,37 @@ class Post():
             return self.info["language"][0]
         return None
 
-    # Getting video and images
+    # Starting the download of video and images. The downloads run in the background, and are only waited for
+    # once the media is needed. Starting them again does nothing.
     def get_media(self):
-        if self.info["media"]["type"] == "image":
-            self.get_images()
-        elif self.info["media"]["type"] == "video":
-            self.get_video()
-        
-   # Function for getting included images. 
-    def get_images(self):
-        for image in self.info["media"]["items"]:
-            # Giving the image just a random filename
-            filename = ''.join(random.choice(string.ascii_lowercase) for i in range(10))
-            # Attempting to get the correct file ending from the image url. 
-            # This is not strictly necessary so if it fails the image is downloaded with no file ending.
-            file_ending = f".{image['url'].split('?')[0].split('.')[-1]}"
-            if len(file_ending) > 5:
-                file_ending = f".{file_ending.split('@')[-1]}"
-            if len(file_ending) > 5:
-                file_ending = ""
-            filename = f"{image_path}{filename}{file_ending}" 
-            logger.info(f"Downloading image from {image['url']} as {filename}")
-            # Downloading fullsize version of image
-            urllib.request.urlretrieve(image['url'], filename)
-            # Checking the image type, mostly to see if it is a gif.
-            local_image = Image.open(filename)
-            # Saving image info in a dictionary and adding it to the list.
-            image_info = {
-                "filename": filename,
-                "alt": image["alt"],
-                "type": local_image.format
-            }
-            self.media.append(image_info)
+        if self.downloads:
+            return
+        self.downloads = start_downloads(self.info["media"])
+        self._media = None
 
-    # Function for getting included video. 
-    def get_video(self):
-        for video in self.info["media"]["items"]:
-            # Giving the video just a random filename
-            filename = ''.join(random.choice(string.ascii_lowercase) for i in range(10)) + ".mp4"
-            filename = image_path + filename
-            response = requests.get(video["url"])
-            if response.status_code != 200:
-                logger.error("Failed to download: %s." % response.text)
-                return 
-            if 'video' not in response.headers.get('Content-Type', ''):
-                logger.error("Response is not a valid video file.")
-                return
-            with open(filename, 'wb') as f:
-                f.write(response.content)
-            logger.info("Video successfully downloaded to %s." % filename)
-            self.media.append({
-                "filename": filename,
-                "alt": video["alt"],
-                "type": "MP4"
-            })
-    
-    # Adding the url to a quoted post to the text, if the quote post setting is set to True
+    # The downloaded media, waiting for downloads that have not finished yet. If a download failed, its error is raised.
+    # A video that could not be downloaded as a video is left out.
+    @property
+    def media(self):
+        if self._media is None:
+            self._media = tuple(item for item in map(get_download, self.downloads) if item)
+        return self._media
+
+    # Adding the url to a quoted post to the text, if the quote post setting is set to True.
+    # Returns the post with the url added, or None if quote posts are not to be crossposted.
     def quote_link(self):
-        if settings.quote_posts and self.info["quote_url"] not in self.info["text"]:
-            self.info["text"] += "\n" + self.info["quote_url"]
-            self.info["urls"].append(self.info["quote_url"])
-        elif not settings.quote_posts:
-            return False
-        return True
+        if not settings.quote_posts:
+            return None
+        if self.info["quote_url"] in self.info["text"]:
+            return self
+        info = dict(self.info)
+        info["text"] += "\n" + self.info["quote_url"]
+        info["urls"] += (self.info["quote_url"],)
+        post = Post(info)
+        # Media that has already started downloading is kept
+        post.downloads = self.downloads
+        post._media = self._media
+        return post
     
     # Checking if a post is supposed to post to a specific service
     def post_toggle(self, service):
@@ -151,3 +123,31 @@ class Post():
                 text = text.replace(str(i).zfill(2)+ "_" + url[:max_url_length-3], url)
             i += 1
         return text
+
+
+# The part of a post that is specific to a single service: how it is to be sent, and the text split to fit the service.
+# The post itself is shared between the views of every service.
+class PostView():
+    def __init__(self, post, service, type):
+        self.post = post
+        self.id = post.info["post_id"]
+        self.service = service
+        # post, reply, repost or quote
+        self.type = type
+        # The text of the post split for the service, made the first time it is needed
+        self.text = {}
+        # How far delivery to the service has come, see the outbox
+        self.state = "pending"
+        self.chunks_posted = 0
+        # Media uploads started before the post is sent, for services that process media after it is uploaded
+        self.uploads = None
+
+    # The media to upload, waiting for it to finish downloading the first time it is needed
+    @property
+    def media(self):
+        return self.post.media
+
+    def text_content(self, addition = ""):
+        if addition not in self.text:
+            self.text[addition] = self.post.text_content(self.service, addition)
+        return self.text[addition]
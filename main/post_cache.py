@@ -0,0 +1,101 @@
+import os, arrow
+from collections import deque
+from main.functions import logger, atomic_write
+
+
+# Cache of posts sent within the last hour, used to limit posts per hour and to find reposts and deletions.
+# Posts are kept in a queue ordered by the time they were sent, so that posts falling outside of the
+# window can be dropped from the front of the queue without going through the whole cache.
+class PostCache():
+    def __init__(self, hours = 1):
+        self.hours = hours
+        # The time each post was last sent
+        self.times = {}
+        # Posts in the order they were sent. A post sent again is added again, and the older
+        # occurrence is skipped when it reaches the front of the queue.
+        self.queue = deque()
+        self.latest = None
+
+    # Reading the cache file, keeping only the posts still within the window. Returns True if any posts
+    # were dropped, meaning the cache file needs to be saved again.
+    def read(self, path):
+        dropped = False
+        if not os.path.exists(path):
+            logger.info(f"{path} not found.")
+            return dropped
+        posts = []
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    post_id = str(line.split(";")[0])
+                    timestamp = int(line.split(";")[1].split(".")[0])
+                    timestamp = arrow.Arrow.fromtimestamp(timestamp)
+                except Exception as e:
+                    logger.error(e)
+                    continue
+                posts.append((timestamp, post_id))
+        for timestamp, post_id in sorted(posts):
+            self[post_id] = timestamp
+        dropped = self.evict() or len(self.times) < len(posts)
+        return dropped
+
+    # Writing the entire cache in one write. Returns the number of bytes written.
+    def save(self, path):
+        self.evict()
+        return atomic_write(path, (f"{post_id};{self.times[post_id].timestamp()}\n" for post_id in self.times))
+
+    # Dropping posts sent before the start of the window. Returns True if any posts were dropped.
+    def evict(self):
+        limit = arrow.utcnow().shift(hours = -self.hours)
+        dropped = False
+        while self.queue and self.queue[0][0] <= limit:
+            timestamp, post_id = self.queue.popleft()
+            # Only removing the post if this is the last time it was sent
+            if self.times.get(post_id) is timestamp:
+                del self.times[post_id]
+                dropped = True
+        if not self.times:
+            self.latest = None
+        return dropped
+
+    # The time the most recent post was sent, or None if no posts have been sent within the window
+    def last_sent(self):
+        self.evict()
+        return self.latest
+
+    def __setitem__(self, post_id, timestamp):
+        self.times[post_id] = timestamp
+        # Posts are almost always added in order. If not, the queue is sorted again.
+        if self.queue and timestamp < self.queue[-1][0]:
+            self.queue.append((timestamp, post_id))
+            self.queue = deque(sorted(self.queue, key = lambda item: item[0]))
+        else:
+            self.queue.append((timestamp, post_id))
+        if not self.latest or timestamp > self.latest:
+            self.latest = timestamp
+
+    def __getitem__(self, post_id):
+        return self.times[post_id]
+
+    def __delitem__(self, post_id):
+        timestamp = self.times.pop(post_id)
+        # The entry left in the queue is skipped once it reaches the front. Only if the most recent post was
+        # removed does the whole cache need to be checked.
+        if timestamp == self.latest:
+            self.latest = max(self.times.values(), default = None)
+
+    def __contains__(self, post_id):
+        return post_id in self.times
+
+    def __len__(self):
+        self.evict()
+        return len(self.times)
+
+    def __iter__(self):
+        return iter(list(self.times))
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __repr__(self):
+        return f"PostCache({self.times})"
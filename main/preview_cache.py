@@ -0,0 +1,110 @@
+import os, json, hashlib, arrow
+from collections import OrderedDict
+from settings import settings
+from settings.paths import preview_cache_path, preview_path
+from main.functions import logger, atomic_write
+
+
+# Cache of link previews made for Bluesky posts, so that a link posted again, or a post that is retried, does not fetch
+# and process the preview again. Every preview is kept for preview_cache_hours, and once the thumbnails take up more
+# than preview_cache_size megabytes, the previews used least recently are dropped. Thumbnails are stored as files
+# next to the cache, after being shrunk to fit. The blob of an uploaded thumbnail is kept for as long as it can be used.
+class PreviewCache():
+    def __init__(self, hours, megabytes):
+        self.hours = hours
+        self.max_size = megabytes * 1024 * 1024
+        # Previews by url, in the order they were last used
+        self.items = OrderedDict()
+
+    def read(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as file:
+                for url, item in json.load(file):
+                    self.items[url] = item
+        except Exception as e:
+            logger.error(f"Could not read preview cache: {e}")
+        self.evict()
+
+    def save(self):
+        atomic_write(preview_cache_path, [json.dumps(list(self.items.items()))])
+
+    # Dropping previews that are too old, and then the least recently used ones until the thumbnails fit
+    def evict(self):
+        limit = arrow.utcnow().shift(hours = -self.hours).int_timestamp
+        for url in [url for url, item in self.items.items() if item["created"] <= limit]:
+            self.remove(url)
+        size = sum(item["size"] for item in self.items.values())
+        while size > self.max_size:
+            url = next(iter(self.items))
+            size -= self.items[url]["size"]
+            self.remove(url)
+
+    def remove(self, url):
+        item = self.items.pop(url)
+        if item["thumb"]:
+            try:
+                os.remove(preview_path + item["thumb"])
+            except OSError as e:
+                logger.warning(f"Could not remove cached preview image: {e}")
+
+    # Getting the preview of a url, or None if it is not cached. The thumbnail is returned as bytes.
+    def get(self, url):
+        item = self.items.get(url)
+        if not item or item["created"] <= arrow.utcnow().shift(hours = -self.hours).int_timestamp:
+            return None
+        image = None
+        if item["thumb"]:
+            try:
+                with open(preview_path + item["thumb"], 'rb') as file:
+                    image = file.read()
+            except OSError:
+                return None
+        logger.info(f"Using cached preview of {url}")
+        self.items.move_to_end(url)
+        self.save()
+        return {
+            "title": item["title"],
+            "description": item["description"],
+            "image": image
+        }
+
+    def add(self, url, title, description, image):
+        if url in self.items:
+            self.remove(url)
+        thumb = None
+        if image:
+            os.makedirs(preview_path, exist_ok = True)
+            thumb = hashlib.sha256(url.encode("utf-8")).hexdigest()
+            with open(preview_path + thumb, 'wb') as file:
+                file.write(image)
+        self.items[url] = {
+            "title": title,
+            "description": description,
+            "thumb": thumb,
+            "size": len(image) if image else 0,
+            "created": arrow.utcnow().int_timestamp,
+            "blob": None,
+            "blob_expires": 0
+        }
+        self.evict()
+        self.save()
+
+    # Getting the uploaded thumbnail of a url, if it can still be used
+    def get_blob(self, url):
+        item = self.items.get(url)
+        if not item or item["blob_expires"] <= arrow.utcnow().int_timestamp:
+            return None
+        return item["blob"]
+
+    def set_blob(self, url, blob, minutes):
+        if url not in self.items:
+            return
+        self.items[url]["blob"] = blob
+        self.items[url]["blob_expires"] = arrow.utcnow().shift(minutes = minutes).int_timestamp
+        self.save()
+
+
+preview_cache = PreviewCache(settings.preview_cache_hours, settings.preview_cache_size)
+preview_cache.read(preview_cache_path)
@@ -0,0 +1,322 @@
+import json, os, sqlite3, gzip, arrow
+from settings.paths import *
+from settings import settings
+from main.functions import atomic_write, logger
+from main.entry import Entry, services, statuses
+
+
+# Setting the identifying id to the ID relating to the current input source, unless the post has not been
+# posted to that service, in which case the ID from the posts origin will be used.
+def get_key(entry):
+    id = entry.get_id(settings.input_source)
+    if id and id not in statuses:
+        return str(id)
+    return str(entry.origin_id())
+
+
+# Storing the database as a file of json lines, with changes appended to a journal as they are made.
+# Posts older than the archive limit are moved to a compressed archive which is only read when
+# a post can't be found among the recent ones.
+class JournalStorage():
+    def __init__(self):
+        self.journal = None
+        self.journal_records = 0
+        self.bytes_written = 0
+        # The archived posts by key. The archive is read the first time it is needed, and kept for the rest of the run.
+        self.archived = None
+        # Whether the archive file holds posts that are no longer archived, or holds a post more than once
+        self.archive_changed = False
+        # Posts removed since the database file was last written. They can still be found in the archive until
+        # it is rewritten, and are left out when it is read.
+        self.removed = set()
+
+    # Reading database file and replaying the journal on top of it
+    def load(self):
+        db_data = []
+        if os.path.exists(database_path):
+            with open(database_path, 'r') as file:
+                for line in file:
+                    try:
+                        db_data.append(json.loads(line))
+                    except:
+                        continue
+        # If the database is still in the old format there is no journal to replay
+        if db_data and "origin" not in db_data[0]:
+            return db_data
+        # Posts stored before the creation time was added are given the current time, so that they are archived
+        # once they have been around long enough.
+        now = arrow.utcnow().int_timestamp
+        entries = {}
+        for line in db_data:
+            entry = Entry.from_dict(line, now)
+            entries[get_key(entry)] = entry
+        self.read_journal(entries, now)
+        return list(entries.values())
+
+    # Replaying changes made since the database file was last written
+    def read_journal(self, entries, now):
+        if not os.path.exists(journal_path):
+            return
+        logger.info("Replaying database journal")
+        with open(journal_path, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except:
+                    # A partially written last line means the run was interrupted mid-write, the change it
+                    # contained was never confirmed and can be ignored.
+                    continue
+                entry = Entry.from_dict(record["entry"], now)
+                key = get_key(entry)
+                if record["op"] == "remove":
+                    entries.pop(key, None)
+                    self.removed.add(key)
+                else:
+                    entries[key] = entry
+                    self.removed.discard(key)
+                self.journal_records += 1
+        logger.info(f"Replayed {self.journal_records} journal records")
+
+    # Every recent post is loaded when the database is read, so the only place left to look is the archive.
+    # Since the archive is read in full, this is only done when it is possible for the post to be archived.
+    # A post found in the archive is moved back among the recent posts, and is archived again along with them.
+    def get(self, key, archived = True):
+        if not archived or not os.path.exists(archive_path):
+            return None
+        entry = self.read_archive().pop(key, None)
+        if entry:
+            self.archive_changed = True
+        return entry
+
+    # Reading every archived post, leaving out the posts that have been removed since
+    def read_archive(self):
+        if self.archived is not None:
+            return self.archived
+        self.archived = {}
+        if os.path.exists(archive_path):
+            logger.info("Reading database archive")
+            count = 0
+            for entry in archived_entries():
+                self.archived[get_key(entry)] = entry
+                count += 1
+            self.archive_changed = count != len(self.archived)
+        for key in self.removed:
+            if self.archived.pop(key, None):
+                self.archive_changed = True
+        return self.archived
+
+    # Getting posts created since a given time. Old posts are archived, so only the recent posts need to be checked.
+    def recent(self, post_list, since):
+        return [entry for entry in post_list.values() if entry.created >= since]
+
+    # Appending a change to the journal. The record is flushed to disk before returning, so a post is
+    # safely stored as soon as the function making the change returns.
+    def write(self, entry, op = "set"):
+        if not self.journal:
+            self.journal = open(journal_path, 'a')
+        record = {
+            "op": op,
+            "entry": entry.to_dict()
+        }
+        if op == "remove":
+            self.removed.add(get_key(entry))
+        else:
+            self.removed.discard(get_key(entry))
+        line = json.dumps(record) + "\n"
+        self.journal.write(line)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_records += 1
+        self.bytes_written += len(line.encode("utf-8"))
+
+    def delete(self, entry):
+        self.write(entry, "remove")
+
+    # Since all changes are already stored in the journal, the database file is only rewritten
+    # once the journal has grown past the compaction threshold.
+    def save(self, post_list):
+        if self.journal_records >= settings.journal_compact_threshold:
+            self.compact(post_list)
+
+    # Writing the entire database to file and emptying the journal. The database is written to a temporary file
+    # which then replaces the old one, so that an interruption never leaves a half written database.
+    def compact(self, post_list):
+        self.archive(post_list)
+        logger.info("Saving database")
+        self.bytes_written += atomic_write(database_path, (json.dumps(post_list[id].to_dict()) + "\n" for id in post_list))
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+        self.journal_records = 0
+        self.removed = set()
+
+    # Moving posts older than the archive limit from the database file to the archive. The limit is never shorter
+    # than the post time limit, since posts within it are checked without looking in the archive.
+    # The archive is rewritten with every post in it once, and without the posts removed since the last time, since
+    # the journal recording their removal is emptied after this.
+    def archive(self, post_list):
+        old = []
+        if settings.archive_after:
+            hours = max(settings.archive_after * 24, settings.post_time_limit)
+            cutoff = arrow.utcnow().shift(hours = -hours).int_timestamp
+            old = [key for key in post_list if post_list[key].created < cutoff]
+        # Posts that have been removed are left out when the archive is read, so they are only found by reading it
+        if self.removed and os.path.exists(archive_path):
+            self.read_archive()
+        if not old and not self.archive_changed:
+            return
+        archived = self.read_archive()
+        if old:
+            logger.info(f"Archiving {len(old)} posts older than {hours} hours")
+        for key in old:
+            archived[key] = post_list.pop(key)
+        temp_path = f"{archive_path}.tmp"
+        with gzip.open(temp_path, "wt") as file:
+            for entry in archived.values():
+                file.write(json.dumps(entry.to_dict()) + "\n")
+        os.replace(temp_path, archive_path)
+        self.bytes_written += os.path.getsize(archive_path)
+        self.archive_changed = False
+
+    # Going through every post once, for backups. A post that has been brought back from the archive
+    # is only found among the recent posts. Since backups are taken in a separate thread, the archive is read again.
+    def export(self, post_list):
+        archived = {}
+        if os.path.exists(archive_path):
+            for entry in archived_entries():
+                archived[get_key(entry)] = entry
+        for key in list(post_list) + list(self.removed):
+            archived.pop(key, None)
+        for entry in archived.values():
+            yield entry
+        for entry in list(post_list.values()):
+            yield entry
+
+
+# Reading the posts in the archive, in the order they were archived. Archives written before posts were only archived
+# once can contain a post more than once, in which case the last version is the current one.
+def archived_entries():
+    try:
+        with gzip.open(archive_path, "rt") as file:
+            for line in file:
+                yield Entry.from_dict(json.loads(line))
+    except (EOFError, OSError, ValueError) as e:
+        # An interrupted archiving leaves a broken end of the file. Everything before it can still be read.
+        logger.warning(f"Could not read entire database archive: {e}")
+
+
+# Storing the database in SQLite, with an index on the ID of every service so that posts can be
+# looked up one at a time instead of reading the whole database on every run.
+class SqliteStorage():
+    def __init__(self):
+        # SQLite handles its own writes, so only the number of posts written is known
+        self.bytes_written = None
+        # Posts are sent from worker threads. The connection is only used while holding the lock of the database.
+        self.connection = sqlite3.connect(sqlite_path, check_same_thread = False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.columns = ["origin", "origin_id", "created"]
+        for service in services:
+            self.columns += [f"{service}_id", f"{service}_failure"]
+            # Bluesky requires both CID and URI to interact with posts.
+            if service == "bluesky":
+                self.columns.append("bluesky_uri")
+        with self.connection:
+            self.connection.execute(f"""CREATE TABLE IF NOT EXISTS posts (
+                origin TEXT NOT NULL,
+                origin_id TEXT NOT NULL,
+                created INTEGER NOT NULL,
+                {", ".join(f"{column} TEXT" if not column.endswith("_failure") else f"{column} INTEGER DEFAULT 0" for column in self.columns[3:])},
+                PRIMARY KEY (origin, origin_id)
+            )""")
+            for service in services:
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS posts_{service}_id ON posts ({service}_id)")
+            # The primary key starts with the origin, so it can not be used to look up a post by its origin id alone
+            self.connection.execute("CREATE INDEX IF NOT EXISTS posts_origin_id ON posts (origin_id)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS posts_created ON posts (created)")
+
+    def empty(self):
+        return self.connection.execute("SELECT 1 FROM posts LIMIT 1").fetchone() is None
+
+    # Posts are looked up as they are needed, so nothing is loaded up front
+    def load(self):
+        return []
+
+    # Looking up a post by the same identifying id that is used as key in the post list
+    def get(self, key, archived = True):
+        rows = self.connection.execute(
+            f"SELECT * FROM posts WHERE {settings.input_source}_id = ? OR origin_id = ?", (key, key)
+        ).fetchall()
+        for row in rows:
+            entry = self.to_entry(row)
+            if get_key(entry) == key:
+                return entry
+        return None
+
+    # Getting posts created since a given time
+    def recent(self, post_list, since):
+        rows = self.connection.execute("SELECT * FROM posts WHERE created >= ?", (since,)).fetchall()
+        return [self.to_entry(row) for row in rows]
+
+    def write(self, entry):
+        self.write_many([entry])
+
+    # Writing several entries in a single transaction
+    def write_many(self, entries):
+        placeholders = ", ".join("?" for _ in self.columns)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in self.columns[3:])
+        rows = []
+        for entry in entries:
+            row = self.to_row(entry)
+            rows.append([row[column] for column in self.columns])
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT INTO posts ({', '.join(self.columns)}) VALUES ({placeholders}) "
+                f"ON CONFLICT (origin, origin_id) DO UPDATE SET {updates}",
+                rows
+            )
+
+    def delete(self, entry):
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM posts WHERE origin = ? AND origin_id = ?",
+                (entry.origin, str(entry.origin_id()))
+            )
+
+    # Every change is committed as it is made, so there is nothing left to do when saving.
+    def save(self, post_list):
+        pass
+
+    # Going through every post, for backups. Since backups are taken in a separate thread, a separate connection is used.
+    def export(self, post_list):
+        connection = sqlite3.connect(sqlite_path)
+        connection.row_factory = sqlite3.Row
+        try:
+            for row in connection.execute("SELECT * FROM posts"):
+                yield self.to_entry(row)
+        finally:
+            connection.close()
+
+    # Translating between database rows and database entries
+    def to_row(self, entry):
+        row = {
+            "origin": entry.origin,
+            "origin_id": str(entry.origin_id()),
+            # Posts are never archived in SQLite, so a post that is not dated is stored as created long ago
+            "created": entry.created if entry.dated else 0,
+            "bluesky_uri": entry.uri
+        }
+        for service in services:
+            row[f"{service}_id"] = entry.get_id(service)
+            row[f"{service}_failure"] = entry.get_failure(service)
+        return row
+
+    def to_entry(self, row):
+        entry = Entry(row["origin"], row["created"])
+        for service in services:
+            entry.set_id(service, row[f"{service}_id"])
+            entry.set_failure(service, row[f"{service}_failure"])
+        entry.uri = row["bluesky_uri"]
+        return entry
@@ -0,0 +1,84 @@
+import os, json, hashlib, threading, arrow
+from settings.paths import upload_cache_path
+from main.functions import logger, atomic_write
+
+
+# How long an upload can be used again on each service, in minutes. Twitter media IDs expire after a day,
+# Mastodon removes media not attached to a post after a day, and Bluesky removes blobs that no post refers to
+# after about an hour. Some margin is left to each.
+expiry = {
+    "twitter": 23 * 60,
+    "mastodon": 23 * 60,
+    "bluesky": 45
+}
+
+
+# Cache of media uploaded to each service, keyed by the service and a hash of the file uploaded. If posting fails
+# after the media has been uploaded, the next attempt at the post uses the uploaded media instead of uploading it again.
+class UploadCache():
+    def __init__(self):
+        self.items = {}
+        # Media is uploaded from several threads at once
+        self.lock = threading.Lock()
+
+    def read(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as file:
+                self.items = json.load(file)
+        except Exception as e:
+            logger.error(f"Could not read upload cache: {e}")
+        self.evict()
+
+    def save(self):
+        atomic_write(upload_cache_path, [json.dumps(self.items)])
+
+    # Dropping uploads that are too old to be used again
+    def evict(self):
+        now = arrow.utcnow().int_timestamp
+        for key in [key for key, item in self.items.items() if item["expires"] <= now]:
+            del self.items[key]
+
+    # Getting the upload of a file to a service, or None if it has not been uploaded or has expired
+    def get(self, service, digest):
+        with self.lock:
+            item = self.items.get(f"{service}:{digest}")
+            if not item or item["expires"] <= arrow.utcnow().int_timestamp:
+                return None
+            logger.info(f"Using media already uploaded to {service}")
+            return item["upload"]
+
+    def add(self, service, digest, upload):
+        with self.lock:
+            self.evict()
+            self.items[f"{service}:{digest}"] = {
+                "upload": upload,
+                "expires": arrow.utcnow().shift(minutes = expiry[service]).int_timestamp
+            }
+            self.save()
+
+    # Removing uploads that can not be used again, such as Mastodon media once it has been attached to a post
+    def remove(self, service, uploads):
+        with self.lock:
+            keys = [key for key, item in self.items.items() if key.startswith(f"{service}:") and item["upload"] in uploads]
+            for key in keys:
+                del self.items[key]
+            if keys:
+                self.save()
+
+
+# Getting the hash of a file, used to recognise media that has been uploaded before. Anything else uploaded along with
+# the file, such as alt text, is included in the hash.
+def file_digest(filename, *extra):
+    digest = hashlib.sha256()
+    for value in extra:
+        digest.update(f"{value}\n".encode("utf-8"))
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+upload_cache = UploadCache()
+upload_cache.read(upload_cache_path)
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-import  traceback, re, ffmpeg, httpx, base64, io, sys, magic, html
+import  traceback, re, ffmpeg, base64, io, sys, magic, html
 from PIL import Image 
 from operator import itemgetter
 from atproto import  models, client_utils, AtUri, IdResolver
@@ -7,48 +7,57 @@ from linkpreview import link_preview
 from main.functions import logger
 from main.connections import bsky_connect
 from main.db import database
+from main.outbox import outbox
+from main.media import upload_all
+from main.upload_cache import upload_cache, file_digest, expiry
+from main.preview_cache import preview_cache
+from main.http import http_client
 from settings import settings
 
 # Keeping a memory of reply references for the run to avoid having to do a bunch of repeat lookups
 reply_references = {}
 
-# Function for processing output queue
-def output(queue):
-    logger.info("Posting queue to Bluesky.")
-    for item in queue:
-        try:
-            if item["type"] == "repost":
-                repost(item)
-            else:
-                post(item)
-        except Exception as e:
-            if item["post"]:
-                database.failed_post(item["id"], "bluesky")
-            logger.error(f"Failed to post {item['id']}: {e}")
-            logger.debug(traceback.format_exc())
+# Function for sending a single post from the queue
+def send(item):
+    logger.info(f"Sending {item.id} to Bluesky.")
+    try:
+        if item.type == "repost":
+            repost(item)
+        else:
+            post(item)
+    except Exception as e:
+        if item.post:
+            database.failed_post(item.id, "bluesky")
+        logger.error(f"Failed to post {item.id}: {e}")
+        logger.debug(traceback.format_exc())
 
 # Function for sending post
 def post(item):
     bluesky_client = bsky_connect()
-    text_content = item["post"].text_content("bluesky")
+    text_content = item.text_content()
     reply_to = None
     root_ref = None
     reply_ref = None
-    urls = item["post"].info["urls"]
-    tags = item["post"].info["tags"]
-    # putting media in a new variable so that it can be removed after posting
-    media = item["post"].media
+    # build_post removes urls and tags from the lists as they are used, so the post is given its own copies
+    urls = list(item.post.info["urls"])
+    tags = list(item.post.info["tags"])
+    # putting media in a new variable so that it can be removed after posting.
+    # If delivery is resumed after the first part has been posted, the media has already been posted with it.
+    media = item.media if not item.chunks_posted else ()
     media_type = None
     if media:
-        media_type = item["post"].info["media"]["type"]
+        media_type = item.post.info["media"]["type"]
     reply = False
-    if item["type"] == "reply":
+    if item.type == "reply" or item.chunks_posted:
         reply = True
     # Bluesky has multiple options for sensitive media, but Mastodon only has the one, so "graphic-media" is used as a catchall.
     labels = []
-    if item["post"].info["sensitive"]:
+    if item.post.info["sensitive"]:
         labels.append("graphic-media")
-    for text_post in text_content:
+    for i, text_post in enumerate(text_content):
+        # Skipping the parts already posted before delivery was interrupted
+        if i < item.chunks_posted:
+            continue
         logger.info(f"Posting \"{text_post}\" to Bluesky")
         # If post contains a single URL, attempting to create a link preview (or repost, if link is to a Bluesky post)
         embed = None
@@ -68,42 +77,27 @@ def post(item):
             logger.info(f"Posting as a reply")
             # Fetching reply_id. If post is a reply without a reply_id this means
             # post is replying to "itself", as it is a longer post being split into smaller chunks.
-            reply_id = item["post"].info["reply_id"]
+            reply_id = item.post.info["reply_id"]
             if not reply_id:
-                reply_id = item["id"]
+                reply_id = item.id
             post_id, post_uri = database.get_id(reply_id, "bluesky")
             if not post_id or post_id in ["skipped", "FailedToPost", "duplicate"]:
-                logger.info(f"Can't continue thread since {item['post'].info['reply_id']} has not been crossposted")
+                logger.info(f"Can't continue thread since {item.post.info['reply_id']} has not been crossposted")
                 continue
             reply_ref, root_ref = get_post_ref(post_uri, post_id)
             reply_to = models.AppBskyFeedPost.ReplyRef(parent=reply_ref, root=root_ref)
         # Posting with images
         if media and media_type == "image":
-            images = []
-            image_alts = []
-            aspect_ratios = []
-            for media_item in media:
-                with open(media_item["filename"], 'rb') as f:
-                    img_data = f.read()
-                    if img_data and sys.getsizeof(img_data) > 976560:
-                        logger.warning(f"Preview image too large to post ({sys.getsizeof(img_data)} is larger than max size 976560)")
-                        img_data = limit_img_size(img_data, 976560)
-                    images.append(img_data)
-                # If image alt is None, instead append empty string
-                if not media_item["alt"]:
-                    image_alts.append("")
-                else:
-                    image_alts.append(media_item["alt"])
-                aspect_ratios.append(get_aspect_ratio(media_item["filename"], "image"))
-            logger.debug(f"bluesky_client.send_images({bluesky_post}, images={media}, image_alts={image_alts}, image_aspect_ratios={aspect_ratios},labels={labels},langs={item['post'].info['language']},reply_to={reply_to})")
+            outbox.update(item, "uploading-media")
+            # The images are uploaded, or taken from the upload cache, before being embedded in the post
+            embed = create_image_embeds(media)
+            logger.debug(f"bluesky_client.send_post({bluesky_post}, embed={embed},labels={labels},langs={item.post.info['language']},reply_to={reply_to})")
             reply_ref = models.create_strong_ref(
-                            bluesky_client.send_images(
+                            bluesky_client.send_post(
                                 bluesky_post,
-                                images=images,
-                                image_alts=image_alts,
-                                image_aspect_ratios=aspect_ratios,
+                                embed=embed,
                                 labels=labels,
-                                langs=item["post"].info["language"],
+                                langs=item.post.info["language"],
                                 reply_to=reply_to
                             )
                         )
@@ -114,32 +108,29 @@ def post(item):
             # No service today supports more than one video per post, but the videos are still stored in a list so that they can be handled
             # similarly to images. Until then, the single item is simply extracted.
             video_data = media[0]
-            with open(video_data["filename"], 'rb') as f:
-                video = f.read()
-            aspect_ratio = get_aspect_ratio(video_data["filename"], "video")
-            logger.debug(f"bluesky_client.send_video({bluesky_post},video={video},video_alt={video_data['alt']},video_aspect_ratio={aspect_ratio},labels={labels},langs={item['post'].info['language']})")
+            outbox.update(item, "uploading-media")
+            embed = create_video_embed(video_data)
+            logger.debug(f"bluesky_client.send_post({bluesky_post},embed={embed},labels={labels},langs={item.post.info['language']})")
             reply_ref = models.create_strong_ref(
-                        bluesky_client.send_video(
+                        bluesky_client.send_post(
                             bluesky_post,
-                            video=video,
-                            video_alt=video_data["alt"],
-                            video_aspect_ratio=aspect_ratio,
+                            embed=embed,
                             labels=labels,
-                            langs=item["post"].info["language"]
+                            langs=item.post.info["language"]
                         )
                     )
             # Emptying media array after posting
             media = []
         # Posting regular post (might include media as an embed)
         else:
-            logger.info(f"bluesky_client.send_post({bluesky_post},reply_to={reply_to},labels={labels},langs={item['post'].info['language']}")
+            logger.info(f"bluesky_client.send_post({bluesky_post},reply_to={reply_to},labels={labels},langs={item.post.info['language']}")
             reply_ref = models.create_strong_ref(
                 bluesky_client.send_post(
                     bluesky_post,
                     reply_to=reply_to,
                     embed=embed,
                     labels=labels,
-                    langs=item["post"].info["language"]
+                    langs=item.post.info["language"]
                 )
             )
         # No root_ref it means the post is the start of the thread, i.e. the root.
@@ -152,15 +143,17 @@ def post(item):
         }
         # If long posts have had to be split subsequent posts are to be treated as replies
         reply = True
-        database.update(item["id"], "bluesky", reply_ref.cid, reply_ref.uri)
-        set_reply_settings(item["post"], reply_ref.uri)
+        database.update(item.id, "bluesky", reply_ref.cid, reply_ref.uri)
+        outbox.posted_chunk(item, i + 1)
+        set_reply_settings(item.post, reply_ref.uri)
+    outbox.update(item, "done")
 
 # Function for reposting
 def repost(item):
     bluesky_client = bsky_connect()
-    post_id, post_uri = database.get_id(item["id"], "bluesky")
+    post_id, post_uri = database.get_id(item.id, "bluesky")
     response = bluesky_client.repost(uri=post_uri, cid=post_id)
-    database.update(item["id"], "bluesky")
+    database.update(item.id, "bluesky")
     logger.info(f"reposted post {post_id}")
     logger.trace(response)
 
@@ -253,42 +246,28 @@ def create_embed(url, media, media_type):
         # It's not possible to include both media embeds and a url preview. 
         if media:
             return None
-        # Creating URL preview
+        # Creating URL preview, using the cached one if the url has been previewed recently
         logger.info("Creating URL preview.")
-        preview = link_preview(url)
-        img_data = None
-        # Getting image for preview, either from URL or from base64-string
-        if preview.image and preview.image.startswith("http"):
-            img_data = httpx.get(preview.image).content
-        elif preview.image and preview.image.startswith("data:image/png;base64"):
-            img_data = base64.b64decode(preview.image.split(",")[1])
-        elif preview.image:
-            logger.warning("Preview image in unknown format, skipping.")
-            logger.debug(preview.image)
-        mime = magic.from_buffer(io.BytesIO(img_data).read(2048), mime=True)
-        if not mime.startswith("image"):
-            logger.info(f"Preview image data not an image type: {mime}")
-            img_data = None
-        if img_data and sys.getsizeof(img_data) > 976560:
-            logger.warning(f"Preview image too large to post ({sys.getsizeof(img_data)} is larger than max size 976560)")
-            img_data = limit_img_size(img_data, 976560)
+        preview = preview_cache.get(url)
+        if not preview:
+            preview = get_preview(url)
+            preview_cache.add(url, preview["title"], preview["description"], preview["image"])
         image = None
-        # Uploading image data
-        if img_data:
-            image = bluesky_client.upload_blob(img_data).blob
-        title = ""
-        if preview.title:
-            title = html.unescape(preview.title)
-        description = ""
-        if preview.description:
-            description = html.unescape(preview.description)
+        # Uploading image data, unless it has been uploaded already and the blob can still be used
+        if preview["image"]:
+            blob = preview_cache.get_blob(url)
+            if blob:
+                image = models.blob_ref.BlobRef.model_validate(blob)
+            else:
+                image = bluesky_client.upload_blob(preview["image"]).blob
+                preview_cache.set_blob(url, image.model_dump(mode = "json", by_alias = True), expiry["bluesky"])
         # If no info is found for the preview, skipping creating one
-        if not title and not description and not image:
+        if not preview["title"] and not preview["description"] and not image:
             return None
         return models.AppBskyEmbedExternal.Main(
             external=models.AppBskyEmbedExternal.External(
-                title=title,
-                description=description,
+                title=preview["title"],
+                description=preview["description"],
                 uri=url,
                 thumb=image
             ),
@@ -298,6 +277,39 @@ def create_embed(url, media, media_type):
         logger.debug(traceback.format_exc())
         return None
 
+# Fetching the title, description and image of a link preview. The image is shrunk to fit in a post.
+def get_preview(url):
+    # The page is fetched through the shared HTTP client, with the same size limit link_preview uses by itself
+    page_url, content = http_client.get_page(url, 1048576)
+    preview = link_preview(page_url, content)
+    img_data = None
+    # Getting image for preview, either from URL or from base64-string
+    if preview.image and preview.image.startswith("http"):
+        img_data = http_client.get(preview.image).content
+    elif preview.image and preview.image.startswith("data:image/png;base64"):
+        img_data = base64.b64decode(preview.image.split(",")[1])
+    elif preview.image:
+        logger.warning("Preview image in unknown format, skipping.")
+        logger.debug(preview.image)
+    mime = magic.from_buffer(io.BytesIO(img_data).read(2048), mime=True)
+    if not mime.startswith("image"):
+        logger.info(f"Preview image data not an image type: {mime}")
+        img_data = None
+    if img_data and sys.getsizeof(img_data) > 976560:
+        logger.warning(f"Preview image too large to post ({sys.getsizeof(img_data)} is larger than max size 976560)")
+        img_data = limit_img_size(img_data, 976560)
+    title = ""
+    if preview.title:
+        title = html.unescape(preview.title)
+    description = ""
+    if preview.description:
+        description = html.unescape(preview.description)
+    return {
+        "title": title,
+        "description": description,
+        "image": img_data
+    }
+
 def limit_img_size(image_data, target_filesize):
     logger.info("Attempting to reduce size of image")
     try:
@@ -344,36 +356,59 @@ def create_media_embeds(media, media_type):
 def create_image_embeds(images):
     bluesky_client = bsky_connect()
     logger.debug(f"Embedding images: {images}")
-    image_embeds = []
-    for image_data in images:
-        logger.info(f"Uploading {image_data['filename']}")
-        with open(image_data["filename"], "rb") as f:
-            image = f.read()
-        blob = bluesky_client.upload_blob(image).blob
-        image_embed = models.AppBskyEmbedImages.Image(
-                    image=blob,
-                    alt=image_data["alt"],
-                    aspect_ratio=get_aspect_ratio(image_data["filename"], "image"),
-                )
-        logger.debug(image_embed)
-        image_embeds.append(image_embed)
+    image_embeds = upload_all(create_image_embed, images)
     logger.debug(images)
     embed = models.AppBskyEmbedImages.Main(images=image_embeds)
     return embed
 
+# Uploading a single image for an image embed
+def create_image_embed(image_data):
+    logger.info(f"Uploading {image_data['filename']}")
+    blob = upload_blob(image_data["filename"], read_image)
+    image_embed = models.AppBskyEmbedImages.Image(
+                image=blob,
+                # If image alt is None, an empty string is used instead
+                alt=image_data["alt"] or "",
+                aspect_ratio=get_aspect_ratio(image_data["filename"], "image"),
+            )
+    logger.debug(image_embed)
+    return image_embed
+
+# Reading an image to upload, shrinking it if it is too large for Bluesky
+def read_image(filename):
+    with open(filename, 'rb') as f:
+        img_data = f.read()
+    if img_data and sys.getsizeof(img_data) > 976560:
+        logger.warning(f"Preview image too large to post ({sys.getsizeof(img_data)} is larger than max size 976560)")
+        img_data = limit_img_size(img_data, 976560)
+    return img_data
+
+def read_video(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
 # Creating video embed
 def create_video_embed(video_data):
-    bluesky_client = bsky_connect()
-    with open(video_data["filename"], "rb") as f:
-        video = f.read()
-    blob = bluesky_client.upload_blob(video)
+    blob = upload_blob(video_data["filename"], read_video)
     embed = models.AppBskyEmbedVideo.Main(
-        video=blob.blob,
+        video=blob,
         alt=video_data["alt"],
-        video_aspect_ratio=get_aspect_ratio(video_data["filename"], "video")
+        aspect_ratio=get_aspect_ratio(video_data["filename"], "video")
     )
     return embed
 
+# Uploading a file as a blob. A blob uploaded for an earlier attempt at the post is used again if it has not expired,
+# in which case the file is not read or shrunk again.
+def upload_blob(filename, read):
+    digest = file_digest(filename)
+    blob = upload_cache.get("bluesky", digest)
+    if blob:
+        return models.blob_ref.BlobRef.model_validate(blob)
+    bluesky_client = bsky_connect()
+    blob = bluesky_client.upload_blob(read(filename)).blob
+    upload_cache.add("bluesky", digest, blob.model_dump(mode = "json", by_alias = True))
+    return blob
+
 # Shortening URLs as Bluesky doesn't automatically do this.
 def shorten_url(url):
     display_url = url.split("/", 2)[2]
@@ -1,103 +1,177 @@
-import traceback
+import traceback, threading, time
+from concurrent.futures import Future
 from main.functions import logger, limit_gif_size
 from main.connections import mastodon_connect
 from settings.auth import MASTODON_HANDLE, MASTODON_INSTANCE
 from settings import settings
 from main.db import database
+from main.outbox import outbox
+from main.media import upload_pool, get_uploads, get_download
+from main.upload_cache import upload_cache, file_digest
 
 
-# Function for processing output queue
-def output(queue):
-    logger.info("Posting queue to Mastodon.")
-    for item in queue:
-        try:
-            if item["type"] == "repost":
-                repost(item)
-            else:
-                post(item)
-        except Exception as e:
-            database.failed_post(item["id"], "mastodon")
-            logger.error(f"Failed to post {item['id']}: {e}")
-            logger.debug(traceback.format_exc())
+# Function for sending a single post from the queue
+def send(item):
+    logger.info(f"Sending {item.id} to Mastodon.")
+    try:
+        if item.type == "repost":
+            repost(item)
+        else:
+            post(item)
+    except Exception as e:
+        database.failed_post(item.id, "mastodon")
+        logger.error(f"Failed to post {item.id}: {e}")
+        logger.debug(traceback.format_exc())
 
 # Function for reposting posts.
 def repost(item):
     mastodon_client = mastodon_connect()
-    post_id = database.get_id(item["id"], "mastodon")
+    post_id = database.get_id(item.id, "mastodon")
     a = mastodon_client.status_reblog(post_id)
-    database.update(item["id"], "mastodon")
+    database.update(item.id, "mastodon")
     logger.info(f"Reposted post on Mastodon: {post_id}")
     logger.debug(a)
 
 # Function for sending posts
 def post(item):
     mastodon_client = mastodon_connect()
-    text_content = item["post"].text_content("mastodon")
-    reply_to_post = database.get_id(item["post"].info["reply_id"], "mastodon")
+    text_content = item.text_content()
+    reply_to_post = database.get_id(item.post.info["reply_id"], "mastodon")
     # Checking to see if post is a reply to a post that has not been crossposted
-    if item["post"].info["reply_id"] and not reply_to_post:
-        logger.info(f"Can't continue thread since {item['post'].info['reply_id']} has not been crossposted")
+    if item.post.info["reply_id"] and not reply_to_post:
+        logger.info(f"Can't continue thread since {item.post.info['reply_id']} has not been crossposted")
         return
     # Since mastodon does not have a quote repost function, quote posts are turned into replies. If the post is both
     # a reply and a quote post, the quote is replaced with a url to the post quoted.
-    if item["type"] == "quote" and item["post"].info["reply_id"]:
-        post_url = MASTODON_INSTANCE + "@" + MASTODON_HANDLE + "/" + str(item["post"].info["quote_id"])
-        reply_to_post = database.get_id(item["post"].info["reply_id"], "mastodon")
-        text_content = item["post"].text_content("mastodon", f"\n{post_url}")
-    elif item["type"] == "quote":
-        reply_to_post = database.get_id(item["post"].info["quote_id"], "mastodon")
+    if item.type == "quote" and item.post.info["reply_id"]:
+        post_url = MASTODON_INSTANCE + "@" + MASTODON_HANDLE + "/" + str(item.post.info["quote_id"])
+        reply_to_post = database.get_id(item.post.info["reply_id"], "mastodon")
+        text_content = item.text_content(f"\n{post_url}")
+    elif item.type == "quote":
+        reply_to_post = database.get_id(item.post.info["quote_id"], "mastodon")
         if not reply_to_post:
-            logger.info(f"Can't post quote since {item['post'].info['quote_id']} has not been crossposted")
+            logger.info(f"Can't post quote since {item.post.info['quote_id']} has not been crossposted")
             return
     # Doing a second check to see if post is a reply or quote of a post that has been skipped or failed to br crossposted.
     if reply_to_post in ["skipped", "FailedToPost", "duplicate"]:
         logger.info(f"Post is a reply to or qoute post of a post that has not been crossposted.")
         return
-    visibility = set_visibility(item["post"])
+    visibility = set_visibility(item.post)
     # If language is not used to toggle what posts to send, it is used simply as the language of the post.
     # Mastodon only takes one language per post, so the first one in the list is used.
     language = None
     if not settings.lang_toggle["mastodon"]:
-        language = item["post"].get_main_language()
+        language = item.post.get_main_language()
+    # If delivery is resumed after the first part has been posted, the rest of the thread continues from the last part posted,
+    # and the media has already been posted with the first part.
+    if item.chunks_posted:
+        reply_to_post = database.get_id(item.id, "mastodon")
     media_ids = []
     # If post includes images, images are uploaded so that they can be included in the toot
-    if item["post"].media:
-        for media_item in item["post"].media:
-            # If alt text was added to the image on bluesky, it's also added to the image on mastodon,
-            # otherwise it will be uploaded without alt text.
-            alt = media_item["alt"]
-            # Abiding by alt character limit
-            if len(alt) > 1500:
-                alt = alt[:1496] + "..."
-            filename = media_item['filename']
-            if media_item["type"] == "GIF":
-                filename = limit_gif_size(filename, 16000000)
-            logger.info(f"Uploading media {filename} with alt: {alt} to mastodon")
-            res = mastodon_client.media_post(filename, description=alt, synchronous=True)
-            media_ids.append(res.id)
-    for text_post in text_content:
+    if item.media and not item.chunks_posted:
+        outbox.update(item, "uploading-media")
+        # The uploads are normally started while the post is queued
+        if item.uploads is None:
+            start_uploads(item)
+        media_ids = [id for id in get_uploads(item.uploads) if id]
+    for i, text_post in enumerate(text_content):
+        # Skipping the parts already posted before delivery was interrupted
+        if i < item.chunks_posted:
+            continue
         logger.info(f"Posting \"{text_post}\" to Mastodon")
         # API won't handle leading spaces. Tricking it by replacing the first leading space with a no-break space.
         if text_post.startswith(" "):
             text_post = text_post.replace(" ", "\u00A0", 1)
-        logger.debug(f"mastodon_client.status_post({text_post}, in_reply_to_id={reply_to_post}, media_ids={media_ids[:4]}, visibility={visibility}, language={language}), sensitive={item['post'].info['sensitive']}")
-        a = mastodon_client.status_post(text_post, in_reply_to_id=reply_to_post, media_ids=media_ids[:4], visibility=visibility, language=language, sensitive=item["post"].info["sensitive"])
+        logger.debug(f"mastodon_client.status_post({text_post}, in_reply_to_id={reply_to_post}, media_ids={media_ids[:4]}, visibility={visibility}, language={language}), sensitive={item.post.info['sensitive']}")
+        a = mastodon_client.status_post(text_post, in_reply_to_id=reply_to_post, media_ids=media_ids[:4], visibility=visibility, language=language, sensitive=item.post.info["sensitive"])
         logger.debug(a)
         reply_to_post = a["id"]
+        # Media attached to a post can not be attached to another
+        upload_cache.remove("mastodon", media_ids[:4])
         # setting media ids to empty to not end up posting the media in every post in the thread
         media_ids = media_ids[4:]
-        database.update(item["id"], "mastodon", a["id"])
+        database.update(item.id, "mastodon", a["id"])
+        outbox.posted_chunk(item, i + 1)
     while media_ids:
         logger.info(f"Posting additional images to Mastodon")
-        logger.debug(f"mastodon_client.status_post('', in_reply_to_id={reply_to_post}, media_ids={media_ids[:4]}, visibility={visibility}, language={language}), sensitive={item['post'].info['sensitive']}")
-        a = mastodon_client.status_post("", in_reply_to_id=reply_to_post, media_ids=media_ids[:4], visibility=visibility, language=language, sensitive=item["post"].info["sensitive"])
+        logger.debug(f"mastodon_client.status_post('', in_reply_to_id={reply_to_post}, media_ids={media_ids[:4]}, visibility={visibility}, language={language}), sensitive={item.post.info['sensitive']}")
+        a = mastodon_client.status_post("", in_reply_to_id=reply_to_post, media_ids=media_ids[:4], visibility=visibility, language=language, sensitive=item.post.info["sensitive"])
         logger.debug(a)
         reply_to_post = a["id"]
+        upload_cache.remove("mastodon", media_ids[:4])
         # setting media ids to empty to not end up posting the media in every post in the thread
         media_ids = media_ids[4:]
-        database.update(item["id"], "mastodon", a["id"])
+        database.update(item.id, "mastodon", a["id"])
+    outbox.update(item, "done")
     logger.info("Posted to mastodon")
 
+# Mastodon processes video and gifs after they have been uploaded, which can take a while. The media of a post is
+# therefore uploaded as soon as it is known that the post can be sent, and processed while the posts before it are sent.
+# Every file is uploaded once it has finished downloading, and gets a future that is done once the file is ready.
+def start_uploads(item):
+    if item.type == "repost" or item.chunks_posted or not item.post.downloads:
+        return
+    mastodon_connect()
+    item.uploads = []
+    for download in item.post.downloads:
+        upload = Future()
+        download.add_done_callback(lambda download, upload = upload: upload_pool.submit(upload_download, download, upload))
+        item.uploads.append(upload)
+
+# Uploading a file that has been downloaded. If the download failed, so does the upload, and with it the post.
+# Files uploaded by an earlier attempt at the post that were never attached to it are used again.
+def upload_download(download, upload):
+    try:
+        media_item = get_download(download)
+        if not media_item:
+            upload.set_result(None)
+            return
+        digest = file_digest(media_item["filename"], media_item["alt"])
+        id = upload_cache.get("mastodon", digest)
+        if id:
+            upload.set_result(id)
+            return
+        check_processing(upload_media(media_item), upload, digest, 0.5, time.monotonic() + settings.processing_timeout)
+    except Exception as e:
+        upload.set_exception(e)
+
+# Uploading a single media file without waiting for it to be processed
+def upload_media(media_item):
+    mastodon_client = mastodon_connect()
+    # If alt text was added to the image on bluesky, it's also added to the image on mastodon,
+    # otherwise it will be uploaded without alt text.
+    alt = media_item["alt"]
+    # Abiding by alt character limit
+    if len(alt) > 1500:
+        alt = alt[:1496] + "..."
+    filename = media_item['filename']
+    if media_item["type"] == "GIF":
+        filename = limit_gif_size(filename, 16000000)
+    logger.info(f"Uploading media {filename} with alt: {alt} to mastodon")
+    return mastodon_client.media_post(filename, description=alt)
+
+# Checking if Mastodon has finished processing an uploaded file. If not, it is checked again after a delay that grows
+# the longer it takes. No upload worker is held while waiting, so other files keep uploading in the meantime.
+# If the file is still not processed by the deadline, the upload is given up on.
+def check_processing(attachment, upload, digest, delay, deadline):
+    if attachment.get("url") is not None:
+        upload_cache.add("mastodon", digest, attachment["id"])
+        upload.set_result(attachment["id"])
+        return
+    if time.monotonic() >= deadline:
+        upload.set_exception(TimeoutError(f"Mastodon did not process media {attachment['id']} within {settings.processing_timeout} seconds"))
+        return
+    logger.info(f"Checking again in {delay} seconds if Mastodon has processed media {attachment['id']}")
+    timer = threading.Timer(delay, upload_pool.submit, [poll_processing, attachment["id"], upload, digest, min(delay * 2, 8), deadline])
+    timer.daemon = True
+    timer.start()
+
+def poll_processing(id, upload, digest, delay, deadline):
+    try:
+        check_processing(mastodon_connect().media(id), upload, digest, delay, deadline)
+    except Exception as e:
+        upload.set_exception(e)
+
 # Function for deleting post. Takes ID of post from origin (Bluesky)
 def delete_post(origin_id):
     mastodon_client = mastodon_connect()
@@ -1,25 +1,226 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from settings import settings
 from output import twitter, mastodon, bluesky
+from main.functions import logger
 from main.db import database
+from main.entry import statuses
+from main.outbox import outbox
 
-# Function for processing post queue
+# Modules sending posts to each service
+modules = {
+    "bluesky": bluesky,
+    "mastodon": mastodon,
+    "twitter": twitter
+}
+
+# Every service has a single worker thread, which sends posts and deletions to that service one at a time, in the
+# order they were handed to it. The services work side by side, so a slow service does not hold up the others.
+# Separate threads of posts are therefore not sent to the same service at the same time either. Doing so would let
+# posts show up on the service in a different order than they were written in.
+workers = {service: ThreadPoolExecutor(max_workers = 1, thread_name_prefix = service) for service in modules}
+
+
+# Posts are handed to the workers through a scheduler that knows which posts depend on which. On each service, a reply
+# depends on the post it replies to and a quote on the post it quotes. Since a service sends its posts in order,
+# a post is always sent after the posts it depends on. If a post is not crossposted, every post queued behind it that
+# depends on it is given up on at once, instead of each being tried in turn. If the post is to be tried again, the posts
+# depending on it are kept in the outbox to be tried along with it. If it never will be, as when it was skipped or has
+# failed too many times, they are dropped.
+class Scheduler():
+    def __init__(self):
+        self.condition = threading.Condition()
+        # The state of every post handled, by id and service. One of "queued", "sent", "failed" and "dropped".
+        self.states = {}
+        # The queued posts, and the queued posts depending on each post
+        self.queued = {}
+        self.dependents = {}
+        # The number of queued posts each post is waiting on before its media can start uploading
+        self.waiting = {}
+        # The number of posts handed to the workers that they have not finished
+        self.active = 0
+        self.error = None
+
+    # Getting the posts a post depends on. Reposts only depend on the post having been crossposted before.
+    def parents(self, item):
+        if item.type == "repost":
+            return []
+        ids = [item.post.info["reply_id"]]
+        if item.type == "quote":
+            ids.append(item.post.info["quote_id"])
+        return [(id, item.service) for id in ids if id]
+
+    def add(self, item):
+        key = (item.id, item.service)
+        with self.condition:
+            # Posts that were not handled by this scheduler are looked up in the database
+            parents = [parent for parent in self.parents(item) if parent in self.states]
+            unscheduled = [parent for parent in self.parents(item) if parent not in self.states]
+            failed = next((parent for parent in parents if self.states[parent] in ["failed", "dropped"]), None)
+            if failed:
+                self.give_up(item, failed[0], self.states[failed])
+                return
+            # A post that needs a post an earlier run gave up on can never be sent either
+            skipped = next((parent for parent in self.required(item) if parent in unscheduled and self.skipped(parent)), None)
+            if skipped:
+                self.give_up(item, skipped[0], "dropped")
+                return
+            self.states[key] = "queued"
+            self.queued[key] = item
+            waiting = 0
+            for parent in parents:
+                if self.states[parent] == "queued":
+                    self.dependents.setdefault(parent, []).append(key)
+                    waiting += 1
+            self.active += 1
+            # If a post depends on a post from an earlier run that was never crossposted, it will not be sent either,
+            # and its media is not uploaded. Otherwise the media starts uploading once the posts it depends on have been sent.
+            ready = all(database.crossposted(*parent) for parent in unscheduled)
+            if ready and waiting:
+                self.waiting[key] = waiting
+        if ready and not waiting:
+            self.start_uploads(item)
+        workers[item.service].submit(self.run, item)
+
+    # Getting the posts that must have been crossposted for a post to be sent at all. Every service needs the post
+    # replied to. Twitter needs the quoted post as well, and so does Mastodon for a quote that is not also a reply,
+    # since it is turned into a reply. Otherwise a quote links to the quoted post instead.
+    def required(self, item):
+        if item.type == "repost":
+            return []
+        ids = [item.post.info["reply_id"]]
+        if item.type == "quote" and (item.service == "twitter" or item.service == "mastodon" and not item.post.info["reply_id"]):
+            ids.append(item.post.info["quote_id"])
+        return [(id, item.service) for id in ids if id]
+
+    # Checking if a post not handled by this scheduler has been skipped, has failed too many times or was a duplicate
+    def skipped(self, key):
+        post_id, service = key
+        entry = database.get_entry(post_id)
+        return bool(entry) and entry.get_id(service) in statuses
+
+    # Media for Mastodon starts uploading before the post is sent, so that it is processed by the time it is needed
+    def start_uploads(self, item):
+        if item.service == "mastodon":
+            mastodon.start_uploads(item)
+
+    def run(self, item):
+        key = (item.id, item.service)
+        with self.condition:
+            # The post has been given up on while it was queued
+            if self.states[key] != "queued":
+                self.active -= 1
+                self.condition.notify_all()
+                return
+        state = "failed"
+        try:
+            # The post is stored in the outbox until it has been delivered, so that it can be resumed if it fails
+            outbox.add(item)
+            modules[item.service].send(item)
+            outbox.finish(item)
+            state = self.outcome(item)
+        except Exception as e:
+            logger.error(f"Failed to send {item.id} to {item.service}: {e}")
+            self.error = self.error or e
+        finally:
+            self.finish(item, state)
+
+    # Finding out how sending a post went. A post that was not crossposted is left in the outbox if it is to be
+    # tried again, and is otherwise dropped for good.
+    def outcome(self, item):
+        if database.crossposted(item.id, item.service):
+            return "sent"
+        elif outbox.has(item.id, item.service):
+            return "failed"
+        return "dropped"
+
+    def finish(self, item, state):
+        key = (item.id, item.service)
+        ready = []
+        with self.condition:
+            self.states[key] = state
+            del self.queued[key]
+            self.waiting.pop(key, None)
+            self.active -= 1
+            dependents = self.dependents.pop(key, [])
+            if state != "sent":
+                self.prune(dependents, item.id, state)
+            else:
+                for dependent in dependents:
+                    if dependent not in self.waiting:
+                        continue
+                    self.waiting[dependent] -= 1
+                    if not self.waiting[dependent]:
+                        del self.waiting[dependent]
+                        ready.append(self.queued[dependent])
+            self.condition.notify_all()
+        for dependent in ready:
+            self.start_uploads(dependent)
+
+    # Giving up on every queued post depending on a post that was not crossposted, including the posts depending on those
+    def prune(self, keys, failed_id, state):
+        while keys:
+            key = keys.pop()
+            if self.states[key] != "queued":
+                continue
+            self.waiting.pop(key, None)
+            self.give_up(self.queued.pop(key), failed_id, state)
+            keys.extend(self.dependents.pop(key, []))
+
+    # A post depending on a failed post is left in the outbox, to be tried again together with that post next run.
+    # A post depending on a post that was dropped is dropped as well, since it can never be sent, and is marked
+    # as skipped so that it is not tried again.
+    def give_up(self, item, failed_id, state):
+        logger.info(f"Not sending {item.id} to {item.service} since {failed_id} was not crossposted")
+        self.states[(item.id, item.service)] = state
+        if state == "failed":
+            outbox.add(item)
+            outbox.update(item, "failed")
+        else:
+            outbox.remove(item)
+            database.skip(item.id, item.service)
+
+    # Waiting until fewer than limit posts are unfinished. Errors from the workers are raised here.
+    def wait(self, limit):
+        with self.condition:
+            while self.active >= limit and not self.error:
+                self.condition.wait()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        with self.condition:
+            while self.active:
+                self.condition.wait()
+
+
+# Function for processing post queue. Every post is handed to the workers as soon as it has been parsed, and the
+# next post is read once fewer than posts_in_flight posts are unfinished. Returns the number of posts sent.
 def send_posts(queues):
-    # Running through and posting to each included service
-    for service in queues:
-        if service == "bluesky" and queues[service]:
-            bluesky.output(queues[service])
-        if service == "mastodon" and queues[service]:
-            mastodon.output(queues[service])
-        if service == "twitter" and queues[service]:
-            twitter.output(queues[service])
-    # Running through and deleting deleted posts for each included service.
-    for id in database.deleted:
-        if settings.outputs["twitter"] and settings.input_source != "twitter" and database.get_id(id, "twitter"):
-            twitter.delete_post(id)
-        if settings.outputs["mastodon"] and settings.input_source != "mastodon" and database.get_id(id, "mastodon"):
-            mastodon.delete_post(id)
-        if settings.outputs["bluesky"] and settings.input_source != "bluesky" and database.get_id(id, "bluesky"):
-            bluesky.delete_post(id)
-        database.remove(id)
+    sent = 0
+    scheduler = Scheduler()
+    try:
+        for queue in queues:
+            # Running through and posting to each included service
+            for service in queue:
+                scheduler.add(queue[service])
+            sent += 1
+            scheduler.wait(settings.posts_in_flight)
+    finally:
+        scheduler.close()
+    if scheduler.error:
+        raise scheduler.error
+    return sent
 
 
+# Running through and deleting deleted posts for each included service. The deletions go through the workers
+# of the services, so the services delete side by side, and a post is only removed once every service is done.
+def delete_posts():
+    deletions = {}
+    for id in database.deleted:
+        deletions[id] = [workers[service].submit(modules[service].delete_post, id) for service in modules
+            if settings.outputs[service] and settings.input_source != service and database.crossposted(id, service)]
+    for id, futures in deletions.items():
+        for future in futures:
+            future.result()
+        database.remove(id)
@@ -5,75 +5,64 @@ from settings.auth import *
 from settings import settings
 from settings.paths import rate_limit_path
 from main.db import database
+from main.outbox import outbox
+from main.media import upload_all
+from main.upload_cache import upload_cache, file_digest
 
 
-# Function for processing output queue
-def output(queue):
+# Function for sending a single post from the queue
+def send(item):
     if check_ratelimit_reset():
         return
-    logger.info("Posting queue to Twitter.")
-    for item in queue:
-        try:
-            if item["type"] == "repost" and settings.retweets:
-                repost(item)
-            else:
-                post(item)
-        except tweepy.TooManyRequests:
-            logger.error("Twitter ratelimit reached!")
-            logger.debug(traceback.format_exc())
-            set_ratelimit_reset(arrow.now().shift(days=1).timestamp())
-        except Exception as e:
-            database.failed_post(item["id"], "twitter")
-            logger.error(f"Failed to post {item['id']}: {e}")
-            logger.debug(traceback.format_exc())
+    logger.info(f"Sending {item.id} to Twitter.")
+    try:
+        if item.type == "repost" and settings.retweets:
+            repost(item)
+        else:
+            post(item)
+    except tweepy.TooManyRequests:
+        logger.error("Twitter ratelimit reached!")
+        logger.debug(traceback.format_exc())
+        set_ratelimit_reset(arrow.now().shift(days=1).timestamp())
+    except Exception as e:
+        database.failed_post(item.id, "twitter")
+        logger.error(f"Failed to post {item.id}: {e}")
+        logger.debug(traceback.format_exc())
 
 # Function for posting tweets
 def post(item):
     twitter_api = twitter_api_connect()
     twitter_client = twitter_client_connect()
-    text_content = item["post"].text_content("twitter")
-    quote_id = database.get_id(item["post"].info["quote_id"], "twitter")
-    reply_id = database.get_id(item["post"].info["reply_id"], "twitter")
-    if item["post"].info["reply_id"] and not reply_id or reply_id in ["skipped", "FailedToPost", "duplicate"]:
-        logger.info(f"Can't continue thread since {item['post'].info['reply_id']} has not been crossposted")
+    text_content = item.text_content()
+    quote_id = database.get_id(item.post.info["quote_id"], "twitter")
+    reply_id = database.get_id(item.post.info["reply_id"], "twitter")
+    if item.post.info["reply_id"] and not reply_id or reply_id in ["skipped", "FailedToPost", "duplicate"]:
+        logger.info(f"Can't continue thread since {item.post.info['reply_id']} has not been crossposted")
         return
-    if item["type"] == "quote" and (not quote_id or quote_id in ["skipped", "FailedToPost", "duplicate"]):
-        logger.info(f"Can't create quote post since {item['post'].info['quote_id']} has not been crossposted")
+    if item.type == "quote" and (not quote_id or quote_id in ["skipped", "FailedToPost", "duplicate"]):
+        logger.info(f"Can't create quote post since {item.post.info['quote_id']} has not been crossposted")
         return
     media_ids = None
-    reply_settings = set_reply_settings(item["post"])
+    reply_settings = set_reply_settings(item.post)
     if reply_settings == "everybody":
         reply_settings = None
     # putting media in a new variable so that I can remove it after posting it
-    media = item["post"].media
-    for text_post in text_content:
+    media = item.media
+    # If delivery is resumed after the first part has been posted, the rest of the thread continues from the last part posted,
+    # and the media and quote have already been posted with the first part.
+    if item.chunks_posted:
+        reply_id = database.get_id(item.id, "twitter")
+        quote_id = None
+        media = []
+    for i, text_post in enumerate(text_content):
+        # Skipping the parts already posted before delivery was interrupted
+        if i < item.chunks_posted:
+            continue
         logger.info(f"Posting \"{text_post}\" to Twitter.")
         # If post includes images, images are uploaded so that they can be included in the tweet
         if media:
-            media_ids = []
-            for media_item in media:
-                # Shrinking and chunking uploads of gifs to avoid size limitations
-                chunked = False
-                media_category = None
-                filename = media_item["filename"]
-                if media_item["type"] == "GIF":
-                    chunked = True
-                    media_category = "tweet_gif"
-                    filename = limit_gif_size(filename, 15728640)
-                alt = media_item["alt"]
-                # Abiding by alt character limit
-                if alt and len(alt) > 1000:
-                    alt = alt[:996] + "..."
-                logger.info(f'Uploading media {filename}, chunked={chunked}, media_category={media_category}')
-                res = twitter_api.media_upload(filename, chunked=chunked, media_category=media_category)
-                logger.trace(res)
-                id = res.media_id
-                # If alt text was added to the image on bluesky, it's also added to the image on twitter.
-                if alt:
-                    logger.info(f"Adding alt-text: {alt}")
-                    res = twitter_api.create_media_metadata(id, alt)
-                    logger.trace(res)
-                media_ids.append(id)
+            outbox.update(item, "uploading-media")
+            media_ids = upload_all(upload_media, media)
             media = []
         # API won't handle leading spaces. Tricking it by addigng a "Zero Width Non-Joiner".
         if text_post.startswith(" "):
@@ -86,6 +75,9 @@ def post(item):
         # If a quote post gets split, only the first post quotes, and the second becomes just a reply to that post
         quote_id = None
         reply_id = content["data"]["id"]
+        # Every part is stored as it is posted, so that an interrupted thread can be continued
+        database.update(item.id, "twitter", reply_id)
+        outbox.posted_chunk(item, i + 1)
         # Checking remaining ratelimit and ratelimit reset time
         remaining_ratelimit = int(a.headers["x-rate-limit-remaining"])
         logger.info(f"{remaining_ratelimit} posts remaining until twitter ratelimit is reached")
@@ -93,7 +85,39 @@ def post(item):
         if remaining_ratelimit < 1:
             logger.info("Twitter ratelimit has been reached.")
             set_ratelimit_reset(reset_time)
-    database.update(item["id"], "twitter", reply_id)
+    outbox.update(item, "done")
+
+# Uploading a single media file along with its alt text, returning its ID. Media IDs can be used in more than one tweet,
+# so a file uploaded by an earlier attempt at the post is used again.
+def upload_media(media_item):
+    digest = file_digest(media_item["filename"], media_item["alt"])
+    id = upload_cache.get("twitter", digest)
+    if id:
+        return id
+    twitter_api = twitter_api_connect()
+    # Shrinking and chunking uploads of gifs to avoid size limitations
+    chunked = False
+    media_category = None
+    filename = media_item["filename"]
+    if media_item["type"] == "GIF":
+        chunked = True
+        media_category = "tweet_gif"
+        filename = limit_gif_size(filename, 15728640)
+    alt = media_item["alt"]
+    # Abiding by alt character limit
+    if alt and len(alt) > 1000:
+        alt = alt[:996] + "..."
+    logger.info(f'Uploading media {filename}, chunked={chunked}, media_category={media_category}')
+    res = twitter_api.media_upload(filename, chunked=chunked, media_category=media_category)
+    logger.trace(res)
+    id = res.media_id
+    # If alt text was added to the image on bluesky, it's also added to the image on twitter.
+    if alt:
+        logger.info(f"Adding alt-text: {alt}")
+        res = twitter_api.create_media_metadata(id, alt)
+        logger.trace(res)
+    upload_cache.add("twitter", digest, id)
+    return id
 
 # Function for reposting tweet. Must be enabled in settings
 # as it required the paid version of the Twitter API.
@@ -0,0 +1,9 @@
+import sys
+from main.backup import restore, full_backup_path
+
+# Restoring the database from a backup. The crossposter must not be running while the database is restored.
+# Without arguments the latest full backup is restored along with the changes backed up since. A dated backup
+# kept from before can be restored by giving its path, such as db/database.bak_240131.gz.
+if __name__ == "__main__":
+    if not restore(sys.argv[1] if len(sys.argv) > 1 else full_backup_path):
+        sys.exit(1)
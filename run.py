@@ -1,31 +1,46 @@
-import traceback
+import traceback, time
 from main.functions import logger, cleanup
-from input.fetch import get_posts
-from output.send import send_posts
+from main.media import report_downloads
+from input.fetch import get_posts, get_deleted
+from output.send import send_posts, delete_posts
 from main.db import database
+from settings import settings
+from main.feed_cursor import cursor
+from main.outbox import outbox
+from settings.paths import cursor_path
 
 def run():
+    # Posts are sent as they are read from the input, so fetching and sending happen together
+    start = time.perf_counter()
+    fetched = True
     try:
-        queues = get_posts()
+        sent = send_posts(get_posts())
+        get_deleted()
     except Exception as e:
         logger.error(f"Could not fetch posts: {e}")
         logger.debug(traceback.format_exc())
-        exit()
+        # Posts sent before the error still need to be saved, but deletions were not checked
+        sent = True
+        database.deleted = set()
+        # Posts read ahead of the one that failed were seen but never handed on, so the mark is left where it was
+        fetched = False
+    report_downloads(time.perf_counter() - start)
+    delete_posts()
     # If no new or deleted posts are found, we can skip further actions.
-    if (not queues or not new_posts(queues)) and not database.deleted:
+    if not sent and not database.deleted:
         logger.info("No new posts or newly deleted posts found.")
+        cursor.save(cursor_path, outbox.resolved)
         exit()
-    logger.debug(f"Found posts {queues}")
-    send_posts(queues)
     database.save()
+    if fetched:
+        cursor.save(cursor_path, outbox.resolved)
+    backup = database.backup()
     cleanup()
-
-# Checking queues to see if they contain posts
-def new_posts(queues):
-    for output in queues:
-        if queues[output]:
-            return True
-    return False
+    backup.join()
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    if settings.input_mode == "stream":
+        from input.stream import stream
+        stream()
+    else:
+        run()
\ No newline at end of file
@@ -0,0 +1,8 @@
+import os, sys, tempfile
+
+# The tests are run from the source folder with the settings stubs renamed to .py, the same way as in the Docker image.
+# Every file the crossposter writes, such as the database and the feed cursor, is kept in a temporary folder instead.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp())
+for folder in ["db", "images", "logs"]:
+    os.makedirs(folder, exist_ok = True)
@@ -0,0 +1,131 @@
+import json, threading
+from collections import deque
+from types import SimpleNamespace
+import arrow, pytest
+from websockets.sync.server import serve
+from settings import settings
+from main.feed_cursor import cursor
+from input import stream
+
+
+# Stands in for Jetstream. Every connection is handed the next batch of events, after which the connection is closed.
+class Jetstream():
+    def __init__(self, batches):
+        self.batches = batches
+        self.paths = []
+        self.server = serve(self.handle, "127.0.0.1", 0)
+        self.url = f"ws://127.0.0.1:{self.server.socket.getsockname()[1]}/subscribe"
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+
+    def handle(self, websocket):
+        self.paths.append(websocket.request.path)
+        for event in self.batches.pop(0) if self.batches else []:
+            websocket.send(json.dumps(event))
+
+    def cursors(self):
+        return [path.split("cursor=")[1] for path in self.paths]
+
+
+class StopStream(Exception):
+    pass
+
+
+def commit_event(time_us, rkey):
+    return {
+        "did": "did:plc:test",
+        "time_us": time_us,
+        "kind": "commit",
+        "commit": {"operation": "create", "collection": stream.post_collection, "rkey": rkey}
+    }
+
+
+def post_info(cid):
+    return {
+        "post_id": cid, "text": "Test", "urls": [], "tags": [], "reply_id": None, "quote_id": None, "quote_url": None,
+        "media": None, "sensitive": False, "language": ["en"], "privacy": "public", "repost": False, "created_at": arrow.utcnow()
+    }
+
+
+# Events are handled as they arrive, and once the connection is dropped the stream is picked up again
+# from the time of the last event handled
+def test_stream_resumes_from_cursor(monkeypatch):
+    jetstream = Jetstream([[commit_event(100, "a"), commit_event(200, "b")], [commit_event(300, "c")]])
+    monkeypatch.setattr(settings, "jetstream_url", jetstream.url)
+    monkeypatch.setattr(cursor, "position", {"time_us": 50})
+    monkeypatch.setattr(cursor, "items", deque())
+    monkeypatch.setattr(stream, "bsky_connect", lambda: SimpleNamespace(me = SimpleNamespace(did = "did:plc:test")))
+    monkeypatch.setattr(stream.bluesky, "get_stream_status", lambda bsky, uri: SimpleNamespace(post = SimpleNamespace(cid = uri.split("/")[-1])))
+    monkeypatch.setattr(stream.bluesky, "get_position", lambda status: {"cid": status.post.cid})
+    monkeypatch.setattr(stream.bluesky, "parse_status", lambda bsky, status: post_info(status.post.cid))
+    processed = []
+    monkeypatch.setattr(stream, "process", lambda posts: processed.extend(post.info["post_id"] for post in posts))
+    reconnects = []
+    # The stream reconnects forever, so it is stopped the second time it waits to reconnect
+    def sleep(seconds):
+        reconnects.append(seconds)
+        if len(reconnects) == 2:
+            raise StopStream()
+    monkeypatch.setattr(stream.time, "sleep", sleep)
+    with pytest.raises(StopStream):
+        stream.stream_bluesky()
+    jetstream.server.shutdown()
+    assert processed == ["a", "b", "c"]
+    assert jetstream.cursors() == ["50", "200"]
+    assert [position["time_us"] for post_id, position in cursor.items] == [100, 200, 300]
+
+
+# Posts crossposted within the delete window are not deleted just because the stream was resumed. Only delete events
+# from the stream mark posts as deleted.
+def test_resumed_stream_does_not_delete_candidates(monkeypatch):
+    jetstream = Jetstream([[{"did": "did:plc:test", "time_us": 100, "kind": "identity"}]])
+    monkeypatch.setattr(settings, "jetstream_url", jetstream.url)
+    monkeypatch.setattr(cursor, "position", {"time_us": 50})
+    monkeypatch.setattr(cursor, "items", deque())
+    monkeypatch.setattr(cursor, "save", lambda path, resolved: 0)
+    monkeypatch.setattr(stream.database, "deleted", {"recent"})
+    monkeypatch.setattr(stream, "bsky_connect", lambda: SimpleNamespace(me = SimpleNamespace(did = "did:plc:test")))
+    processed = []
+    monkeypatch.setattr(stream, "process", lambda posts: processed.append(posts))
+    def sleep(seconds):
+        raise StopStream()
+    monkeypatch.setattr(stream.time, "sleep", sleep)
+    with pytest.raises(StopStream):
+        stream.stream_bluesky()
+    jetstream.server.shutdown()
+    assert processed == []
+    assert stream.database.deleted == set()
+
+
+# If the feed can't be read before the stream is started, reading it is tried again instead of stopping the stream
+def test_stream_survives_failed_catch_up(monkeypatch):
+    jetstream = Jetstream([[commit_event(100, "a")]])
+    monkeypatch.setattr(settings, "jetstream_url", jetstream.url)
+    monkeypatch.setattr(cursor, "position", None)
+    monkeypatch.setattr(cursor, "items", deque())
+    monkeypatch.setattr(stream, "bsky_connect", lambda: SimpleNamespace(me = SimpleNamespace(did = "did:plc:test")))
+    monkeypatch.setattr(stream.bluesky, "get_stream_status", lambda bsky, uri: SimpleNamespace(post = SimpleNamespace(cid = uri.split("/")[-1])))
+    monkeypatch.setattr(stream.bluesky, "get_position", lambda status: {"cid": status.post.cid})
+    monkeypatch.setattr(stream.bluesky, "parse_status", lambda bsky, status: post_info(status.post.cid))
+    catch_ups = []
+    def get_posts():
+        catch_ups.append(len(jetstream.paths))
+        if len(catch_ups) == 1:
+            raise ConnectionError("Could not connect to Bluesky")
+        return []
+    monkeypatch.setattr(stream, "get_posts", get_posts)
+    monkeypatch.setattr(stream, "send_posts", lambda queues: list(queues))
+    monkeypatch.setattr(stream, "get_deleted", lambda: None)
+    processed = []
+    monkeypatch.setattr(stream, "process", lambda posts: processed.append([post.info["post_id"] for post in posts]))
+    reconnects = []
+    def sleep(seconds):
+        reconnects.append(seconds)
+        if len(reconnects) == 2:
+            raise StopStream()
+    monkeypatch.setattr(stream.time, "sleep", sleep)
+    with pytest.raises(StopStream):
+        stream.stream_bluesky()
+    jetstream.server.shutdown()
+    assert catch_ups == [0, 0]
+    assert len(jetstream.paths) == 1
+    assert processed == [[], ["a"]]
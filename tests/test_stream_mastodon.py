@@ -0,0 +1,127 @@
+import json, threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import arrow, pytest
+from mastodon import Mastodon, MastodonNetworkError
+from settings import settings
+from main.db import database
+from main.feed_cursor import cursor
+from input import stream
+
+
+# Stands in for the streaming API of a Mastodon instance. Every connection to the user stream is handed the next
+# batch of events as server-sent events, after which the connection is closed.
+class StreamingServer(ThreadingHTTPServer):
+    def __init__(self, batches):
+        super().__init__(("127.0.0.1", 0), StreamingHandler)
+        self.batches = batches
+        self.connections = 0
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+
+
+class StreamingHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/api/v1/streaming/user":
+            self.send_error(404)
+            return
+        self.server.connections += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for name, data in self.server.batches.pop(0) if self.server.batches else []:
+            self.wfile.write(f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StopStream(Exception):
+    pass
+
+
+def status(id, account_id = "1"):
+    return {"id": id, "account": {"id": account_id}, "content": f"<p>Status {id}</p>"}
+
+
+def post_info(status):
+    return {
+        "post_id": str(status.id), "text": status.content, "urls": [], "tags": [], "reply_id": None, "quote_id": None,
+        "quote_url": None, "media": None, "sensitive": False, "language": ["en"], "privacy": "public", "repost": False,
+        "created_at": arrow.utcnow()
+    }
+
+
+# New statuses, edits and deletions are handled as they arrive. Statuses by other accounts in the home timeline are
+# left out, and once the connection is dropped the timeline is read again before the stream is reconnected.
+def test_stream_handles_events_and_reconnects(monkeypatch):
+    server = StreamingServer([
+        [("update", status("101")), ("update", status("102", "2")), ("status.update", status("100")), ("delete", "99")],
+        [("update", status("103"))]
+    ])
+    client = Mastodon(access_token = "token", api_base_url = server.url, version_check_mode = "none")
+    monkeypatch.setattr(client, "me", lambda: {"id": "1"})
+    monkeypatch.setattr(stream, "mastodon_connect", lambda: client)
+    monkeypatch.setattr(stream.mastodon, "parse_status", lambda status, user_id: post_info(status))
+    monkeypatch.setattr(cursor, "items", deque())
+    monkeypatch.setattr(settings, "cross_delete", True)
+    database.add("99")
+    catch_ups = []
+    monkeypatch.setattr(stream, "get_posts", lambda: catch_ups.append(server.connections) or [])
+    monkeypatch.setattr(stream, "send_posts", lambda queues: None)
+    monkeypatch.setattr(stream, "get_deleted", lambda: None)
+    processed = []
+    monkeypatch.setattr(stream, "process", lambda posts: processed.append([post.info["post_id"] for post in posts]))
+    reconnects = []
+    # The stream reconnects forever, so it is stopped the second time it waits to reconnect
+    def sleep(seconds):
+        reconnects.append(seconds)
+        if len(reconnects) == 2:
+            raise StopStream()
+    monkeypatch.setattr(stream.time, "sleep", sleep)
+    with pytest.raises(StopStream):
+        stream.stream_mastodon()
+    server.shutdown()
+    assert server.connections == 2
+    assert catch_ups == [0, 1]
+    # Each connection starts by sending what was found when reading the timeline. The update and the edit are sent,
+    # the deletion is sent on its own, and the status from another account is not sent.
+    assert processed == [[], ["101"], ["100"], [], [], ["103"]]
+    assert "99" in database.deleted
+    # Edits are older than the high-water mark, so only new statuses move it
+    assert [post_id for post_id, position in cursor.items] == ["101", "103"]
+
+
+# If the timeline can't be read because the instance is down, the stream keeps trying instead of stopping
+def test_stream_survives_failed_catch_up(monkeypatch):
+    server = StreamingServer([[("update", status("201"))]])
+    client = Mastodon(access_token = "token", api_base_url = server.url, version_check_mode = "none")
+    monkeypatch.setattr(client, "me", lambda: {"id": "1"})
+    monkeypatch.setattr(stream, "mastodon_connect", lambda: client)
+    monkeypatch.setattr(stream.mastodon, "parse_status", lambda status, user_id: post_info(status))
+    monkeypatch.setattr(cursor, "items", deque())
+    catch_ups = []
+    def get_posts():
+        catch_ups.append(server.connections)
+        if len(catch_ups) == 1:
+            raise MastodonNetworkError("Could not connect to the instance")
+        return []
+    monkeypatch.setattr(stream, "get_posts", get_posts)
+    monkeypatch.setattr(stream, "send_posts", lambda queues: list(queues))
+    monkeypatch.setattr(stream, "get_deleted", lambda: None)
+    processed = []
+    monkeypatch.setattr(stream, "process", lambda posts: processed.append([post.info["post_id"] for post in posts]))
+    reconnects = []
+    def sleep(seconds):
+        reconnects.append(seconds)
+        if len(reconnects) == 2:
+            raise StopStream()
+    monkeypatch.setattr(stream.time, "sleep", sleep)
+    with pytest.raises(StopStream):
+        stream.stream_mastodon()
+    server.shutdown()
+    assert catch_ups == [0, 0]
+    assert server.connections == 1
+    assert processed == [[], ["201"]]
+    assert reconnects == [1, 2]